@@ -0,0 +1,315 @@
+"""
+Offline benchmark of the bot's command handlers.
+
+Runs a bot from main.create_bot against benchmarks.stub_server instead
+of Pixiv and a simulated Discord: contexts and messages that only sleep for the
+configured latency. Every scenario reports p50/p99 latency, throughput
+and the peak memory traced while it ran.
+
+    python -m benchmarks.bench
+    python -m benchmarks.bench --scenario search --scenario flip -n 200
+    python -m benchmarks.bench --save baseline.json
+    python -m benchmarks.bench --baseline baseline.json --max-regression 0.2
+
+With --baseline the exit status is 1 if any scenario's p50 latency or
+throughput regressed by more than --max-regression.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from benchmarks.stub_server import StubServer
+from main import LEFT_ARROW, RIGHT_ARROW, create_bot
+
+TAGS = ('rem', 'miku', 'landscape', 'original', 'cat', 'sky', 'girl', 'city')
+
+SETTINGS = """\
+[DEFAULT]
+pixiv_username =
+pixiv_password =
+refresh_token = bench
+discord_token = bench
+command_prefix = ?
+image_cache_dir = {directory}/image_cache
+image_cache_max_mb = {image_cache_max_mb}
+tag_store_path = {tag_store_path}
+metadata_cache_max_entries = {metadata_cache_max_entries}
+tag_cache_entries = {tag_cache_entries}
+image_workers = {image_workers}
+metrics_port = 0
+"""
+
+
+class FakeChannel:
+    def __init__(self, id: int) -> None:
+        self.id = id
+
+
+class FakeMessage:
+    """A sent message; reactions and deletes only cost latency"""
+
+    ids = itertools.count(1)
+
+    def __init__(self, channel: FakeChannel, latency: float) -> None:
+        self.id = next(self.ids)
+        self.channel = channel
+        self.latency = latency
+
+    async def add_reaction(self, emoji: str) -> None:
+        await asyncio.sleep(self.latency)
+
+    async def delete(self) -> None:
+        await asyncio.sleep(self.latency)
+
+
+class FakeContext:
+    """The parts of commands.Context the command handlers use"""
+
+    def __init__(self, bot, channel_id: int, latency: float) -> None:
+        self.bot = bot
+        self.channel = FakeChannel(channel_id)
+        self.latency = latency
+        self.sent: List[FakeMessage] = []
+
+    async def trigger_typing(self) -> None:
+        pass
+
+    async def send(self, content=None, *, embed=None, file=None, files=None):
+        # read the attachments like an upload would
+        for attachment in ([file] if file else []) + (files or []):
+            attachment.fp.read()
+            attachment.close()
+        await asyncio.sleep(self.latency)
+        message = FakeMessage(self.channel, self.latency)
+        self.sent.append(message)
+        return message
+
+    async def invoke(self, command, **kwargs):
+        return await command.callback(command.cog, self, **kwargs)
+
+
+async def load_bot(directory: str, server: StubServer, args: argparse.Namespace):
+    """
+    Creates a bot with settings in directory, Pixiv pointed at server and
+    the Discord connection stubbed out, logs it in to the stub and returns
+    its PixivCog.
+    """
+    import pixiv_module
+    from scheduler import RequestScheduler
+
+    cold = args.cold
+    path = os.path.join(directory, 'settings.cfg')
+    with open(path, 'w') as cfg:
+        cfg.write(SETTINGS.format(
+            directory=directory,
+            image_cache_max_mb=0 if cold else 512,
+            tag_store_path='' if cold else os.path.join(directory, 'tags.sqlite3'),
+            metadata_cache_max_entries=0 if cold else 2048,
+            tag_cache_entries=0 if cold else 4096,
+            image_workers=args.image_workers))
+
+    pixiv_module.AUTH_URL = f'{server.base_url}/auth/token'
+    pixiv_module.BASE_URL = server.base_url
+
+    bot = create_bot(path)
+
+    async def request(route, **kwargs):
+        await asyncio.sleep(args.discord_latency)
+    bot.http.request = request
+
+    cog = bot.pixiv_cog
+    await cog.login()
+    if not args.rate_limits:
+        cog.pixiv.scheduler = RequestScheduler({}, (1e9, 10 ** 9),
+                                               retry_on=pixiv_module.TRANSIENT_ERRORS)
+    return cog
+
+
+class Scenario:
+    """
+    A benchmarked operation. setup() runs once per worker, untimed, and
+    its result is passed to every op() of the worker.
+    """
+
+    def __init__(self, name: str,
+                 op: Callable[[Any, FakeContext, Any, int], Awaitable[None]],
+                 setup: Optional[Callable[[Any, FakeContext, int], Awaitable[Any]]] = None) -> None:
+        self.name = name
+        self.op = op
+        self.setup = setup
+
+
+async def search_op(cog, ctx, state, i):
+    await ctx.invoke(cog.search, query=f'{TAGS[i % len(TAGS)]}, {TAGS[(i // 3) % len(TAGS)]}')
+
+
+async def open_search(cog, ctx, worker):
+    await ctx.invoke(cog.search, query=TAGS[worker % len(TAGS)])
+    return ctx.sent[-1].id
+
+
+async def flip_op(cog, ctx, message_id, i):
+    session = cog.dispatcher.sessions[message_id]
+    emoji = LEFT_ARROW if i % 4 == 3 else RIGHT_ARROW
+    await cog.dispatcher.dispatch(session.message.id, emoji, 1)
+
+
+async def gallery_op(cog, ctx, state, i):
+    await ctx.invoke(cog.create_gallery, illust_id=i + 1)
+
+
+async def download_op(cog, ctx, state, i):
+    await ctx.invoke(cog.download, illust_id=i + 1)
+
+
+async def related_op(cog, ctx, state, i):
+    await ctx.invoke(cog.search_related, illust_id=i + 1)
+
+
+SCENARIOS = {scenario.name: scenario for scenario in (
+    Scenario('search', search_op),
+    Scenario('flip', flip_op, open_search),
+    Scenario('create_gallery', gallery_op),
+    Scenario('download', download_op),
+    Scenario('search_related', related_op),
+)}
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Nearest-rank percentile of values"""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+async def run_scenario(cog, scenario: Scenario, iterations: int,
+                       concurrency: int, args: argparse.Namespace) -> Dict[str, float]:
+    contexts = [FakeContext(cog.bot, worker, args.discord_latency)
+                for worker in range(concurrency)]
+    states = [None] * concurrency
+    if scenario.setup is not None:
+        states = await asyncio.gather(*[scenario.setup(cog, ctx, worker)
+                                        for worker, ctx in enumerate(contexts)])
+
+    latencies: List[float] = []
+    counter = itertools.count()
+
+    async def worker(ctx, state):
+        for i in iter(lambda: next(counter), None):
+            if i >= iterations:
+                return
+            start = time.perf_counter()
+            await scenario.op(cog, ctx, state, i)
+            latencies.append(time.perf_counter() - start)
+
+    if args.memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    await asyncio.gather(*[worker(ctx, state) for ctx, state in zip(contexts, states)])
+    elapsed = time.perf_counter() - start
+    peak = 0
+    if args.memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    # close what the scenario left open so the next one starts clean
+    for session in list(cog.dispatcher.sessions.values()):
+        await cog.dispatcher.end(session)
+
+    return {
+        'iterations': len(latencies),
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'throughput': len(latencies) / elapsed,
+        'peak_mb': peak / 1024 / 1024,
+    }
+
+
+def compare(results: Dict[str, Dict[str, float]], baseline: Dict[str, Dict[str, float]],
+            max_regression: float) -> List[str]:
+    """Returns a line for every scenario slower than the baseline allows"""
+    failures = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['p50_ms'] > base['p50_ms'] * (1 + max_regression):
+            failures.append(f"{name}: p50 {result['p50_ms']:.1f}ms, baseline {base['p50_ms']:.1f}ms")
+        if result['throughput'] < base['throughput'] * (1 - max_regression):
+            failures.append(f"{name}: {result['throughput']:.1f} ops/s, "
+                            f"baseline {base['throughput']:.1f} ops/s")
+    return failures
+
+
+async def main(args: argparse.Namespace) -> int:
+    server = StubServer(args.port, latency=args.pixiv_latency)
+    await server.start()
+
+    directory = tempfile.mkdtemp(prefix='pixiv-cog-bench-')
+    cog = await load_bot(directory, server, args)
+    cog.dispatcher.start()
+
+    results = {}
+    print(f"{'scenario':<16}{'n':>6}{'p50 ms':>10}{'p99 ms':>10}{'ops/s':>10}{'peak MB':>10}")
+    try:
+        for name in args.scenario or list(SCENARIOS):
+            result = await run_scenario(cog, SCENARIOS[name], args.iterations,
+                                        args.concurrency, args)
+            results[name] = result
+            print(f"{name:<16}{result['iterations']:>6}{result['p50_ms']:>10.1f}"
+                  f"{result['p99_ms']:>10.1f}{result['throughput']:>10.1f}"
+                  f"{result['peak_mb']:>10.1f}")
+    finally:
+        await cog.close()
+        await server.stop()
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            failures = compare(results, json.load(f), args.max_regression)
+        for failure in failures:
+            print(f'REGRESSION {failure}')
+        return 1 if failures else 0
+    return 0
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS),
+                        help='scenario to run, repeatable (default: all)')
+    parser.add_argument('-n', '--iterations', type=int, default=50)
+    parser.add_argument('-c', '--concurrency', type=int, default=8)
+    parser.add_argument('--pixiv-latency', type=float, default=0.02,
+                        help='seconds the stub waits before every response')
+    parser.add_argument('--discord-latency', type=float, default=0.03,
+                        help='seconds every simulated Discord call takes')
+    parser.add_argument('--cold', action='store_true',
+                        help='disable the image, metadata and tag caches')
+    parser.add_argument('--rate-limits', action='store_true',
+                        help='keep the production per-endpoint rate limits')
+    parser.add_argument('--image-workers', type=int, default=0)
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help='skip tracemalloc, which slows every scenario down')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON results to compare against')
+    parser.add_argument('--max-regression', type=float, default=0.2)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main(parse_args())))
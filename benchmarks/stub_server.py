@@ -0,0 +1,174 @@
+"""
+Local stand-in for the Pixiv app API and i.pximg.net. Responses have the
+shape of recorded Pixiv responses; images are synthetic noise, generated
+once per size, so downloads and recompression do realistic work.
+"""
+from aiohttp import web
+from PIL import Image
+
+from io import BytesIO
+from typing import Dict, Optional
+
+import asyncio
+
+# results per search page and pages until next_url is null
+PAGE_SIZE = 30
+SEARCH_PAGES = 5
+
+# side length of the synthetic image of every size, in pixels
+IMAGE_SIDES = {
+    'square_medium': 360,
+    'medium': 540,
+    'large': 1200,
+    'original': 1800,
+}
+
+
+def illust_json(base_url: str, illust_id: int) -> dict:
+    """An illust object as returned by the search and detail endpoints"""
+    pages = illust_id % 3 + 1
+
+    def urls(page: int) -> Dict[str, str]:
+        return {size: f'{base_url}/img/{illust_id}/{page}/{size}'
+                for size in ('square_medium', 'medium', 'large')}
+
+    return {
+        'id': illust_id,
+        'title': f'illust {illust_id}',
+        'type': 'illust',
+        'caption': (f'caption of {illust_id}<br />'
+                    '<a href="https://twitter.com/x">https://twitter.com/x</a>'
+                    ' &amp; more'),
+        'create_date': '2020-11-01T00:00:00+09:00',
+        'width': IMAGE_SIDES['original'],
+        'height': IMAGE_SIDES['original'],
+        'image_urls': urls(0),
+        'is_bookmarked': False,
+        'is_muted': False,
+        'meta_pages': ([{'image_urls': {**urls(page),
+                                        'original': f'{base_url}/img/{illust_id}/{page}/original'}}
+                        for page in range(pages)] if pages > 1 else []),
+        'meta_single_page': ({} if pages > 1 else
+                             {'original_image_url': f'{base_url}/img/{illust_id}/0/original'}),
+        'page_count': pages,
+        'restrict': 0,
+        'sanity_level': 2,
+        'series': None,
+        'tags': [{'name': 'オリジナル', 'translated_name': 'original'}],
+        'tools': [],
+        'total_bookmarks': illust_id * 7919 % 10000,
+        'total_view': illust_id * 104729 % 100000,
+        'user': {'id': 1, 'name': 'artist', 'account': 'artist',
+                 'profile_image_urls': {}, 'is_followed': False},
+        'visible': True,
+        'x_restrict': 0,
+    }
+
+
+class StubServer:
+    """
+    Serves the endpoints the bot uses on 127.0.0.1:port, answering every
+    request after `latency` seconds.
+    """
+
+    def __init__(self, port: int, latency=0.02) -> None:
+        self.port = port
+        self.latency = latency
+        self.base_url = f'http://127.0.0.1:{port}'
+        self.requests = 0
+        self._images: Dict[str, bytes] = {}
+        self._runner: Optional[web.AppRunner] = None
+
+    def image(self, size: str) -> bytes:
+        """The synthetic image of size, encoded as PNG"""
+        if size not in self._images:
+            side = IMAGE_SIDES[size]
+            image = Image.effect_noise((side, side), 64).convert('RGB')
+            buffer = BytesIO()
+            image.save(buffer, format='PNG')
+            self._images[size] = buffer.getvalue()
+        return self._images[size]
+
+    async def _respond(self) -> None:
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+
+    async def auth_token(self, request: web.Request) -> web.Response:
+        await self._respond()
+        form = await request.post()
+        return web.json_response({'response': {
+            'access_token': f'stub-{self.requests}',
+            'refresh_token': form.get('refresh_token') or 'stub',
+            'expires_in': 3600,
+            'user': {'profile_image_urls': {}, 'account': 'bench', 'id': 1,
+                     'name': 'bench', 'mail_address': 'bench@example.com',
+                     'is_premium': False, 'x_restrict': 0,
+                     'is_mail_authorized': True},
+        }})
+
+    async def autocomplete(self, request: web.Request) -> web.Response:
+        await self._respond()
+        word = request.query['word']
+        return web.json_response({'tags': [
+            {'name': f'{word}_jp', 'translated_name': word},
+            {'name': f'{word}_fanart', 'translated_name': f'{word} fan art'},
+            {'name': 'オリジナル', 'translated_name': 'original'},
+        ]})
+
+    async def search(self, request: web.Request) -> web.Response:
+        await self._respond()
+        offset = int(request.query.get('offset', 0))
+        next_offset = offset + PAGE_SIZE
+        return web.json_response({
+            'illusts': [illust_json(self.base_url, offset + index + 1)
+                        for index in range(PAGE_SIZE)],
+            'next_url': (f'{self.base_url}/v1/search/illust?offset={next_offset}'
+                         if next_offset < PAGE_SIZE * SEARCH_PAGES else None),
+            'search_span_limit': 31536000,
+        })
+
+    async def popular_preview(self, request: web.Request) -> web.Response:
+        await self._respond()
+        return web.json_response({'illusts': [illust_json(self.base_url, index + 1)
+                                              for index in range(8)]})
+
+    async def detail(self, request: web.Request) -> web.Response:
+        await self._respond()
+        return web.json_response(
+            {'illust': illust_json(self.base_url, int(request.query['illust_id']))})
+
+    async def related(self, request: web.Request) -> web.Response:
+        await self._respond()
+        illust_id = int(request.query['illust_id'])
+        return web.json_response({
+            'illusts': [illust_json(self.base_url, illust_id * 31 + index)
+                        for index in range(PAGE_SIZE)],
+            'next_url': None,
+        })
+
+    async def image_file(self, request: web.Request) -> web.Response:
+        await self._respond()
+        return web.Response(body=self.image(request.match_info['size']),
+                            content_type='image/png')
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_post('/auth/token', self.auth_token)
+        app.router.add_get('/v2/search/autocomplete', self.autocomplete)
+        app.router.add_get('/v1/search/illust', self.search)
+        app.router.add_get('/v1/search/popular-preview/illust', self.popular_preview)
+        app.router.add_get('/v1/illust/detail', self.detail)
+        app.router.add_get('/v2/illust/related', self.related)
+        app.router.add_get('/img/{illust_id}/{page}/{size}', self.image_file)
+
+        # encode the images up front so they do not count towards a scenario
+        for size in IMAGE_SIDES:
+            self.image(size)
+
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, '127.0.0.1', self.port).start()
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
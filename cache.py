@@ -0,0 +1,374 @@
+from pixivapi.enums import Size
+
+from shared_store import SharedStore
+
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+import asyncio
+import functools
+import os
+import tempfile
+import threading
+import time
+
+# (illustration id, page index, size)
+ImageKey = Tuple[int, int, Size]
+
+TEMP_PREFIX = '.tmp'
+
+
+class ImageCache:
+    """
+    Size-bounded on-disk cache of downloaded images keyed by
+    (illustration id, page, Size).
+        - files are written atomically (temp file + rename)
+        - least recently used files are evicted once the total size of the
+          cache exceeds max_bytes
+        - the index is rebuilt from the directory on start up, so cached
+          images survive restarts
+    Methods do blocking file I/O; async callers should run them in an
+    executor.
+    """
+
+    def __init__(self, directory: str, max_bytes: int) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # filename -> size, oldest first
+
+        os.makedirs(directory, exist_ok=True)
+        self._load_index()
+
+    @staticmethod
+    def filename(key: ImageKey) -> str:
+        illust_id, page, size = key
+        return f'{illust_id}_p{page}_{size.value}'
+
+    def _path(self, filename: str) -> str:
+        return os.path.join(self.directory, filename)
+
+    def _load_index(self) -> None:
+        """Indexes the files already in the directory by modification time"""
+        files = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue
+            if entry.name.startswith(TEMP_PREFIX):
+                # left over from an interrupted write
+                os.remove(entry.path)
+                continue
+            stat = entry.stat()
+            files.append((stat.st_mtime, entry.name, stat.st_size))
+
+        for _, name, size in sorted(files):
+            self._entries[name] = size
+            self.total_bytes += size
+
+        with self._lock:
+            self._evict()
+
+    def _evict(self) -> None:
+        """Removes least recently used files until the cache fits. Needs _lock"""
+        while self.total_bytes > self.max_bytes and self._entries:
+            name, size = self._entries.popitem(last=False)
+            self.total_bytes -= size
+            try:
+                os.remove(self._path(name))
+            except FileNotFoundError:
+                pass
+
+    def _write_file(self, name: str, data: bytes) -> None:
+        """Writes data to the file name atomically"""
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, prefix=TEMP_PREFIX)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, self._path(name))
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def get(self, key: ImageKey) -> Optional[bytes]:
+        """Returns the cached bytes of key, or None on a miss"""
+        name = self.filename(key)
+        with self._lock:
+            if name not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(name)
+
+        try:
+            with open(self._path(name), 'rb') as f:
+                data = f.read()
+            # persist recency for the next start up
+            os.utime(self._path(name))
+        except FileNotFoundError:
+            with self._lock:
+                size = self._entries.pop(name, None)
+                if size is not None:
+                    self.total_bytes -= size
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key: ImageKey, data: bytes) -> None:
+        """Stores data under key, evicting old entries if needed"""
+        if len(data) > self.max_bytes:
+            return
+
+        name = self.filename(key)
+        self._write_file(name, data)
+
+        with self._lock:
+            self.total_bytes += len(data) - self._entries.pop(name, 0)
+            self._entries[name] = len(data)
+            self._evict()
+
+    def hit_ratio(self) -> float:
+        """Returns the share of lookups by this process that were hits"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> dict:
+        """
+        Returns the hit/miss counters and current size of the cache.
+        .. code-block:: python
+           {
+               'hits': 10, 'misses': 2, 'hit_ratio': 0.83,
+               'entries': 12, 'bytes': 4200000,
+           }
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'entries': len(self._entries),
+                'bytes': self.total_bytes,
+            }
+
+
+class SharedImageCache(ImageCache):
+    """
+    ImageCache whose directory is shared by several processes. The index
+    lives in a SharedStore instead of memory, so max_bytes bounds the
+    directory as a whole and an image stored by one process is a hit in
+    every other.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, store: SharedStore) -> None:
+        self.store = store
+        super().__init__(directory, max_bytes)
+
+    def _load_index(self) -> None:
+        """
+        Indexes files that are not in the store yet, e.g. from before the
+        cache was shared, by modification time. They are evicted by the next
+        put() if the directory is too large. Temp files are left alone,
+        another process may be writing them.
+        """
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and not entry.name.startswith(TEMP_PREFIX):
+                stat = entry.stat()
+                files.append((entry.name, stat.st_size, stat.st_mtime))
+        self.store.index_images(files)
+
+    def _index(self, name: str, size: int) -> None:
+        """Indexes a file and deletes the files evicted to make room"""
+        for evicted in self.store.add_image(name, size, self.max_bytes):
+            try:
+                os.remove(self._path(evicted))
+            except FileNotFoundError:
+                pass
+
+    def get(self, key: ImageKey) -> Optional[bytes]:
+        """Returns the cached bytes of key, or None on a miss"""
+        name = self.filename(key)
+        data = None
+        if self.store.image_size(name) is not None:
+            try:
+                with open(self._path(name), 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                self.store.remove_image(name)
+
+        with self._lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return data
+
+    def put(self, key: ImageKey, data: bytes) -> None:
+        """Stores data under key, evicting old entries if needed"""
+        if len(data) > self.max_bytes:
+            return
+
+        name = self.filename(key)
+        self._write_file(name, data)
+        self._index(name, len(data))
+
+    def stats(self) -> dict:
+        """
+        Returns the counters of this process and the size of the shared
+        cache. Reads the store, so async callers should run it in an
+        executor; hit_ratio() does not.
+        """
+        entries, total_bytes = self.store.image_stats()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'entries': entries,
+                'bytes': total_bytes,
+            }
+
+
+class MetadataCache:
+    """
+    In-memory TTL cache of API responses.
+        - every endpoint has its own time to live, see `ttls`
+        - at most max_entries responses are kept, least recently used
+          entries are dropped first
+        - concurrent lookups of the same key share a single fetch
+    Failed fetches are not cached.
+    """
+
+    def __init__(self, max_entries: int, ttls: Dict[str, float],
+                 default_ttl=60.0) -> None:
+        self.max_entries = max_entries
+        self.ttls = dict(ttls)
+        self.default_ttl = default_ttl
+        self.hits = 0
+        self.misses = 0
+
+        self._entries = OrderedDict() # (endpoint, key) -> (expires, value)
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+
+    async def get_or_fetch(self, endpoint: str, key: Hashable,
+                           fetch: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Returns the cached response of endpoint for key, awaiting fetch()
+        on a miss. Callers arriving while a fetch is in flight wait for it
+        instead of starting their own.
+        """
+        cache_key = (endpoint, key)
+
+        entry = self._entries.get(cache_key)
+        if entry is not None:
+            expires, value = entry
+            if expires > time.monotonic():
+                self._entries.move_to_end(cache_key)
+                self.hits += 1
+                return value
+            del self._entries[cache_key]
+
+        future = self._inflight.get(cache_key)
+        if future is None:
+            self.misses += 1
+            future = asyncio.ensure_future(fetch())
+            future.add_done_callback(
+                functools.partial(self._store, cache_key,
+                                  self.ttls.get(endpoint, self.default_ttl)))
+            self._inflight[cache_key] = future
+        else:
+            self.hits += 1
+
+        # shield so a cancelled caller does not cancel the shared fetch
+        return await asyncio.shield(future)
+
+    def _store(self, cache_key: Hashable, ttl: float,
+               future: asyncio.Future) -> None:
+        self._inflight.pop(cache_key, None)
+        if future.cancelled() or future.exception() is not None:
+            return
+
+        self._entries[cache_key] = (time.monotonic() + ttl, future.result())
+        self._entries.move_to_end(cache_key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, endpoint: str, key: Hashable) -> None:
+        """Drops the cached response of endpoint for key"""
+        self._entries.pop((endpoint, key), None)
+
+    def stats(self) -> dict:
+        """Returns the hit/miss counters and number of cached responses"""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'entries': len(self._entries),
+        }
+
+
+class SharedMetadataCache(MetadataCache):
+    """
+    MetadataCache with a SharedStore as second tier, so a response fetched
+    by one process is reused by the others until its ttl runs out.
+    Responses must be picklable. Failures of the store are printed and the
+    response is fetched as if the store were empty.
+    """
+
+    def __init__(self, max_entries: int, ttls: Dict[str, float],
+                 store: SharedStore, default_ttl=60.0) -> None:
+        super().__init__(max_entries, ttls, default_ttl)
+        self.store = store
+        self.shared_hits = 0
+
+        self._ttl_left: Dict[Hashable, float] = {}
+
+    async def get_or_fetch(self, endpoint: str, key: Hashable,
+                           fetch: Callable[[], Awaitable[Any]]) -> Any:
+        ttl = self.ttls.get(endpoint, self.default_ttl)
+        shared_key = repr(key)
+
+        async def fetch_shared():
+            loop = asyncio.get_event_loop()
+            try:
+                found, value, ttl_left = await loop.run_in_executor(
+                    None, self.store.get_response, endpoint, shared_key)
+            except Exception as err:
+                print(f'Shared cache lookup failed: {err!r}')
+                found = False
+
+            if found:
+                self.shared_hits += 1
+                # expire in memory when the stored response does
+                self._ttl_left[(endpoint, key)] = ttl_left
+                return value
+
+            value = await fetch()
+            try:
+                await loop.run_in_executor(None, self.store.put_response,
+                                           endpoint, shared_key, value, ttl)
+            except Exception as err:
+                print(f'Shared cache store failed: {err!r}')
+            return value
+
+        return await super().get_or_fetch(endpoint, key, fetch_shared)
+
+    def _store(self, cache_key: Hashable, ttl: float,
+               future: asyncio.Future) -> None:
+        ttl = min(ttl, self._ttl_left.pop(cache_key, ttl))
+        super()._store(cache_key, ttl, future)
+
+    def stats(self) -> dict:
+        """Also counts the misses answered by the store as `shared_hits`"""
+        stats = super().stats()
+        stats['shared_hits'] = self.shared_hits
+        return stats
@@ -27,3 +27,18 @@ class Credentials:
     def get_item(self, section: str, name: str) -> str:
         """returns the value under section"""
         return self.config.get(section, name)
+
+    def get_int(self, section: str, name: str, fallback: int) -> int:
+        """returns the value under section as an int, or fallback if unset"""
+        value = self.config.get(section, name, fallback='')
+        return int(value) if value.strip() else fallback
+
+    def get_float(self, section: str, name: str, fallback: float) -> float:
+        """returns the value under section as a float, or fallback if unset"""
+        value = self.config.get(section, name, fallback='')
+        return float(value) if value.strip() else fallback
+
+    def get_str(self, section: str, name: str, fallback: str) -> str:
+        """returns the value under section, or fallback if unset"""
+        value = self.config.get(section, name, fallback='')
+        return value.strip() or fallback
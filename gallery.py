@@ -0,0 +1,149 @@
+from pixiv_module import AsyncExtendedClient, IllustRecord, illust_page_urls, illust_referer
+from scheduler import Priority
+from pixivapi.enums import Size
+
+from typing import Awaitable, Dict, List, Optional
+from io import BytesIO
+
+import asyncio
+
+
+def download_page(pixiv: AsyncExtendedClient, illust: IllustRecord, index: int,
+                  size=Size.LARGE,
+                  priority=Priority.NAVIGATION) -> Awaitable[BytesIO]:
+    """Returns a coroutine downloading page index of the illustration at size"""
+    return pixiv.download_byte_stream(
+        illust_page_urls(illust, size)[index], referer=illust_referer(illust),
+        cache_key=(illust.id, index, size), priority=priority)
+
+
+def _consume_exception(task: asyncio.Future) -> None:
+    """
+    Marks the exception of a background download as retrieved, the image is
+    downloaded again when it is actually requested.
+    """
+    if not task.cancelled():
+        task.exception()
+
+
+class PrefetchingSource:
+    """
+    A sequence of images downloaded on demand. An image is fetched the
+    first time it is requested and can be warmed in the background with
+    prefetch(). Indices wrap around, like gallery navigation does.
+
+    With a window, only the images within `window` positions of the last
+    requested index are kept, everything else is cancelled and dropped.
+    """
+
+    def __init__(self, length: int, window: Optional[int] = None) -> None:
+        self.length = length
+        self.window = window
+        self._images: Dict[int, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return self.length
+
+    def _download(self, index: int, priority: Priority) -> Awaitable[BytesIO]:
+        """Returns a coroutine downloading the image at index"""
+        raise NotImplementedError
+
+    def _load(self, index: int, priority=Priority.NAVIGATION) -> asyncio.Future:
+        """Returns the download task of the image, (re)starting it if needed"""
+        task = self._images.get(index)
+        if task is None or (task.done() and
+                            (task.cancelled() or task.exception())):
+            task = asyncio.ensure_future(self._download(index, priority))
+            task.add_done_callback(_consume_exception)
+            self._images[index] = task
+        return task
+
+    def _trim(self, center: int) -> None:
+        """Drops every image outside the window around center"""
+        if self.window is None:
+            return
+
+        keep = {(center + offset) % len(self)
+                for offset in range(-self.window, self.window + 1)}
+        for index in list(self._images):
+            if index not in keep:
+                task = self._images.pop(index)
+                if not task.done():
+                    task.cancel()
+
+    async def get(self, index: int) -> BytesIO:
+        """
+        Returns the image at index, waiting for its download if necessary.
+
+        :raises aiohttp.ClientError: If the download fails.
+        """
+        index = index % len(self)
+        self._trim(index)
+
+        # shield so an abandoned waiter does not cancel the shared download
+        stream = await asyncio.shield(self._load(index))
+        stream.seek(0)
+        return stream
+
+    def prefetch(self, index: int) -> None:
+        """Starts downloading the image at index in the background"""
+        if len(self) > 1:
+            self._load(index % len(self), Priority.PREFETCH)
+
+    def close(self) -> None:
+        """Cancels pending downloads and drops every loaded image"""
+        for task in self._images.values():
+            if not task.done():
+                task.cancel()
+        self._images.clear()
+
+
+class LazyPageSource(PrefetchingSource):
+    """
+    The pages of an illustration. Every page is kept until the source is
+    closed; neighbouring pages are warmed with prefetch().
+    """
+
+    def __init__(self, pixiv: AsyncExtendedClient, illust: IllustRecord,
+                 size=Size.LARGE) -> None:
+        self.pixiv = pixiv
+        self.illust = illust
+        self.size = size
+        super().__init__(len(illust_page_urls(illust, size)))
+
+    def _download(self, index: int, priority: Priority) -> Awaitable[BytesIO]:
+        return download_page(self.pixiv, self.illust, index, self.size, priority)
+
+
+class SearchResultPager(PrefetchingSource):
+    """
+    Previews (the first page) of a list of search results. Showing a result
+    warms the previous and next result in the background, and only those
+    three previews are kept in memory. The list may grow while the pager
+    is in use.
+    """
+
+    def __init__(self, pixiv: AsyncExtendedClient, illusts: List[IllustRecord],
+                 size=Size.LARGE) -> None:
+        self.pixiv = pixiv
+        self.illusts = illusts
+        self.size = size
+        super().__init__(len(illusts), window=1)
+
+    def __len__(self) -> int:
+        return len(self.illusts)
+
+    def _download(self, index: int, priority: Priority) -> Awaitable[BytesIO]:
+        return download_page(self.pixiv, self.illusts[index], 0, self.size, priority)
+
+    async def get(self, index: int) -> BytesIO:
+        """Returns the preview at index and prefetches its neighbours"""
+        index = index % len(self)
+        self._trim(index)
+
+        # start the requested preview ahead of its neighbours
+        self._load(index)
+        self.prefetch(index - 1)
+        self.prefetch(index + 1)
+
+        return await super().get(index)
@@ -0,0 +1,171 @@
+from PIL import Image
+
+from metrics import stage
+
+from concurrent.futures import ProcessPoolExecutor
+from io import BytesIO
+from typing import List, Optional
+
+import asyncio
+import math
+import multiprocessing
+import os
+
+# max download size
+FILE_SIZE_MAX = 7900000
+
+IMAGE_QUALITY = 85
+
+# bounds and number of encodes of the quality binary search
+MIN_QUALITY = 40
+MAX_QUALITY_ATTEMPTS = 5
+
+# longest side of the trial encode used to estimate the full size
+TRIAL_SIZE = 512
+# shrink the estimated scale a little, trial encodes are not exact
+SCALE_MARGIN = 0.9
+# scale applied when even MIN_QUALITY does not fit, and how often
+DOWNSCALE_STEP = 0.75
+MAX_DOWNSCALES = 4
+
+
+def to_rgb(image: Image.Image) -> Image.Image:
+    """
+    Converts the image to a mode JPEG can store, transparent areas are
+    flattened onto a white background.
+    """
+    if image.mode in ('RGB', 'L'):
+        return image
+
+    if image.mode == 'P':
+        image = image.convert('RGBA')
+
+    if image.mode in ('RGBA', 'LA'):
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+
+    return image.convert('RGB')
+
+
+def encode_jpeg(image: Image.Image, quality: int) -> bytes:
+    buffer = BytesIO()
+    image.save(buffer, format='JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def estimate_scale(image: Image.Image, max_bytes: int) -> float:
+    """
+    Estimates the scale the image has to be resized by to fit max_bytes at
+    IMAGE_QUALITY, from the bytes per pixel of a small trial encode.
+    """
+    trial = image.copy()
+    trial.thumbnail((TRIAL_SIZE, TRIAL_SIZE))
+
+    trial_bytes = len(encode_jpeg(trial, IMAGE_QUALITY))
+    estimate = trial_bytes * (image.width * image.height) / (trial.width * trial.height)
+
+    if estimate <= max_bytes:
+        return 1.0
+    return math.sqrt(max_bytes / estimate) * SCALE_MARGIN
+
+
+def search_quality(image: Image.Image, max_bytes: int) -> Optional[bytes]:
+    """
+    Returns the highest quality encode of the image that fits max_bytes,
+    trying IMAGE_QUALITY first and then binary searching down to
+    MIN_QUALITY. None if nothing fits.
+    """
+    data = encode_jpeg(image, IMAGE_QUALITY)
+    if len(data) <= max_bytes:
+        return data
+
+    best = None
+    low, high = MIN_QUALITY, IMAGE_QUALITY - 1
+    for _ in range(MAX_QUALITY_ATTEMPTS):
+        if low > high:
+            break
+        quality = (low + high) // 2
+        data = encode_jpeg(image, quality)
+        if len(data) <= max_bytes:
+            best = data
+            low = quality + 1
+        else:
+            high = quality - 1
+
+    return best
+
+
+def compress_image(data: bytes, max_bytes=FILE_SIZE_MAX) -> bytes:
+    """
+    Re-encodes the image as a JPEG of at most max_bytes, lowering the
+    quality first and the resolution second. Runs inside a worker process,
+    so it takes and returns plain bytes.
+    """
+    image = to_rgb(Image.open(BytesIO(data)))
+    scale = estimate_scale(image, max_bytes)
+
+    for _ in range(MAX_DOWNSCALES + 1):
+        resized = image
+        if scale < 1.0:
+            resized = image.resize((max(1, int(image.width * scale)),
+                                    max(1, int(image.height * scale))),
+                                   Image.LANCZOS)
+
+        result = search_quality(resized, max_bytes)
+        if result is not None:
+            return result
+        scale *= DOWNSCALE_STEP
+
+    # give up on the target, send the smallest attempt
+    return encode_jpeg(resized, MIN_QUALITY)
+
+
+class ImageProcessor:
+    """
+    Recompresses oversized images in a pool of worker processes so the
+    CPU-heavy encode never runs on the event loop thread.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None) -> None:
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self._pool = None
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        """
+        The worker pool, started on first use. By then the bot runs threads,
+        which a forked worker could deadlock on, so workers are started from
+        a forkserver, or spawned where there is none.
+        """
+        if self._pool is None:
+            method = ('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods()
+                      else 'spawn')
+            self._pool = ProcessPoolExecutor(max_workers=self.max_workers,
+                                             mp_context=multiprocessing.get_context(method))
+        return self._pool
+
+    async def process_image(self, image_buffer: BytesIO) -> BytesIO:
+        """
+        Returns image_buffer unchanged if it is below FILE_SIZE_MAX, otherwise
+        a recompressed copy.
+        """
+        if image_buffer.getbuffer().nbytes < FILE_SIZE_MAX:
+            return image_buffer
+
+        loop = asyncio.get_event_loop()
+        with stage('process_image'):
+            data = await loop.run_in_executor(self.pool, compress_image,
+                                              image_buffer.getvalue())
+        return BytesIO(data)
+
+    async def process_images(self, image_buffers: List[BytesIO]) -> List[BytesIO]:
+        """Processes every image in parallel, results are in input order"""
+        return await asyncio.gather(*[self.process_image(buffer)
+                                      for buffer in image_buffers])
+
+    def shutdown(self) -> None:
+        """Stops the worker processes"""
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
@@ -1,29 +1,83 @@
 import discord
 from discord.ext import commands
+from discord.http import Route
 
 import credentials
-from pixiv_module import PixivModule
+from pixiv_module import (AsyncExtendedClient, IllustRecord, PixivModule,
+                          METADATA_TTL)
+from gallery import LazyPageSource, SearchResultPager, download_page
+from reactions import ReactionDispatcher, ReactionSession
+from cache import ImageCache, MetadataCache, SharedImageCache, SharedMetadataCache
+from image_processing import ImageProcessor, FILE_SIZE_MAX
+from tag_matcher import TagMatcher
+from tag_store import TagStore
+from shared_store import SharedStore
+from session_store import SavedSession, SessionStore
+from search import DeepSearch
+from scheduler import Priority
+from metrics import (REGISTRY, STAGE_IN_FLIGHT, STAGE_SECONDS, UPLOADED_BYTES,
+                     CallbackGauge, Trace, current_trace, serve, stage)
 from pixivapi.enums import SearchTarget, Size, ContentType, Sort
-from pixivapi.models import Illustration
 
-from typing import List, Tuple, Dict
+from typing import Awaitable, Callable, List, Optional, Tuple, Dict, Union
 from functools import reduce
 
 import io
+import aiohttp
+import functools
 import asyncio
+import itertools
+import multiprocessing
+import os
 import random
-import re
-from Levenshtein import ratio
-from PIL import Image
-
-
-cred = credentials.Credentials('settings.cfg')
-
-TOKEN           = cred.get_item('DEFAULT', 'discord_token')
-cmd_pref        = cred.get_item('DEFAULT', 'command_prefix')
-pixiv_username  = cred.get_item('DEFAULT', 'pixiv_username')
-pixiv_password  = cred.get_item('DEFAULT', 'pixiv_password')
-pixiv_refresh   = cred.get_refresh_token()
+import time
+import weakref
+
+
+class Settings:
+    """Settings of one bot instance, read from a settings.cfg"""
+
+    def __init__(self, path='settings.cfg') -> None:
+        cred = credentials.Credentials(path)
+        self.credentials = cred
+
+        self.discord_token  = cred.get_item('DEFAULT', 'discord_token')
+        self.command_prefix = cred.get_item('DEFAULT', 'command_prefix')
+        self.pixiv_username = cred.get_item('DEFAULT', 'pixiv_username')
+        self.pixiv_password = cred.get_item('DEFAULT', 'pixiv_password')
+        self.pixiv_refresh  = cred.get_refresh_token()
+
+        self.max_downloads              = cred.get_int('DEFAULT', 'max_downloads', 16)
+        self.max_downloads_per_illust   = cred.get_int('DEFAULT', 'max_downloads_per_illust', 4)
+        self.image_cache_dir            = cred.get_str('DEFAULT', 'image_cache_dir', 'image_cache')
+        self.image_cache_max_mb         = cred.get_int('DEFAULT', 'image_cache_max_mb', 512)
+        self.metadata_cache_max_entries = cred.get_int('DEFAULT', 'metadata_cache_max_entries', 2048)
+        self.max_download_mb            = cred.get_int('DEFAULT', 'max_download_mb', 32)
+        self.image_workers              = cred.get_int('DEFAULT', 'image_workers', 0)
+        self.tag_match_threshold        = cred.get_float('DEFAULT', 'tag_match_threshold', 0.5)
+        self.tag_cache_entries          = cred.get_int('DEFAULT', 'tag_cache_entries', 4096)
+        self.tag_store_path             = cred.get_str('DEFAULT', 'tag_store_path', '')
+        self.tag_store_max_age_days     = cred.get_int('DEFAULT', 'tag_store_max_age_days', 30)
+        self.search_rank_pages          = cred.get_int('DEFAULT', 'search_rank_pages', 0)
+        self.search_preview_size        = Size(cred.get_str('DEFAULT', 'search_preview_size', 'medium'))
+        self.gallery_preview_size       = Size(cred.get_str('DEFAULT', 'gallery_preview_size', 'large'))
+        self.preview_upgrade_delay      = cred.get_float('DEFAULT', 'preview_upgrade_delay', 2.0)
+        self.metrics_host               = cred.get_str('DEFAULT', 'metrics_host', '127.0.0.1')
+        self.metrics_port               = cred.get_int('DEFAULT', 'metrics_port', 0)
+        self.trace_commands             = {name.strip()
+                                           for name in cred.get_str('DEFAULT', 'trace_commands', '').split(',')
+                                           if name.strip()}
+        self.shard_count                = cred.get_int('DEFAULT', 'shard_count', 0)
+        # more worker processes than shards would leave some idle
+        self.shard_processes            = max(1, min(cred.get_int('DEFAULT', 'shard_processes', 1),
+                                                     self.shard_count or 1))
+        self.shared_store_path          = cred.get_str('DEFAULT', 'shared_store_path', '')
+        self.session_store_path         = cred.get_str('DEFAULT', 'session_store_path', '')
+        self.session_max_age_hours      = cred.get_float('DEFAULT', 'session_max_age_hours', 24.0)
+
+        # set for each worker process by run_worker
+        self.shard_ids = None
+        self.rate_share = 1.0
 
 
 
@@ -40,526 +94,1147 @@ async def add_reactions(msg):
     await msg.add_reaction(DOWNLOAD)
 
 
+# API version whose message edit replaces attachments
+EDIT_API_BASE = 'https://discord.com/api/v9'
+
+async def edit_message_file(ctx, msg, embed: discord.Embed, file: discord.File):
+    """
+    Replaces the embed and attachment of msg in place, keeping its reactions.
+    discord.py cannot edit attachments, so the multipart PATCH is sent through
+    the HTTP session of ctx's bot.
+
+    :raises discord.HTTPException: If the message cannot be edited.
+    """
+    route = Route('PATCH', '/channels/{channel_id}/messages/{message_id}',
+                  channel_id=msg.channel.id, message_id=msg.id)
+    route.url = route.url.replace(Route.BASE, EDIT_API_BASE, 1)
+
+    form = aiohttp.FormData()
+    form.add_field('payload_json', discord.utils.to_json({
+        'embeds': [embed.to_dict()],
+        'attachments': [], # drop the previous image
+    }))
+    form.add_field('file', file.fp, filename=file.filename,
+                   content_type='application/octet-stream')
+
+    size = file.fp.getbuffer().nbytes
+    try:
+        with stage('discord:edit'):
+            await ctx.bot.http.request(route, data=form, files=[file])
+    finally:
+        file.close()
+    # counted once sent, a failed edit is resent and counted by send_message
+    UPLOADED_BYTES.inc(size)
+
+
+async def send_message(ctx, **kwargs):
+    """ctx.send, timed and counted as a Discord upload"""
+    files = kwargs.get('files') or ([kwargs['file']] if kwargs.get('file') else [])
+    size = sum(file.fp.getbuffer().nbytes for file in files)
+    with stage('discord:send'):
+        message = await ctx.send(**kwargs)
+    UPLOADED_BYTES.inc(size)
+    return message
+
+
+async def replace_message(ctx, msg, embed: discord.Embed, file: discord.File):
+    """
+    Shows embed and file in msg. Edits the message in place when possible,
+    otherwise deletes it and sends a new one with fresh reactions.
+
+    :return: The message now showing the embed, msg itself if it was edited
+    """
+    try:
+        await edit_message_file(ctx, msg, embed, file)
+        return msg
+    except discord.HTTPException as err:
+        print(f'Editing message {msg.id} failed, resending: {err}')
+
+    file.reset()
+    await msg.delete()
+    new_msg = await send_message(ctx, embed=embed, file=file)
+    await add_reactions(new_msg)
+    return new_msg
+
+
+# seconds to wait for the autocompletion of a single tag
+TAG_TIMEOUT = 5.0
+
+# seconds an idle session stays in memory, saved sessions are revived
+# after that, see PixivCog.revive_session
+TIMEOUT = 30.0
+
+# size previews are upgraded to once the user stays on a page
+UPGRADE_SIZE = Size.LARGE
+
+
+# discord embed length limits
+EMBED_TITLE_MAX = 256
+EMBED_DESCRIPTION_MAX = 2048
+
+
+def truncate(text: str, limit: int) -> str:
+    """Shortens text to at most limit characters, marking the cut"""
+    if len(text) <= limit:
+        return text
+    return text[:limit - 1] + '\u2026'
+
+
+def create_embed(title: str, description: str) -> discord.Embed:
+    """
+    Creates the discord.Embed of a gallery. Captions are expected to be
+    cleaned already, see pixiv_module.clean_caption.
+    """
+    return discord.Embed(title=truncate(title, EMBED_TITLE_MAX),
+                         description=truncate(description, EMBED_DESCRIPTION_MAX),
+                         color=0x00cec9)
+
+
+def set_embed_image(embed: discord.Embed, image_name: str,
+                    file_stream: io.BytesIO) -> discord.File:
+    """
+    Points the embed's image at image_name and returns the attachment of
+    the image's BytesIO Stream. Everything else on the embed is kept, so
+    page flips can reuse the embed.
+    """
+    embed.set_image(url=f"attachment://{image_name}.jpg")
+
+    # reset image byte stream back to 0
+    file_stream.seek(0)
+    return discord.File(fp=file_stream, filename=f"{image_name}.jpg")
+
+
+def create_embed_file(title: str,
+                      description: str,
+                      image_name:str,
+                      file_stream: io.BytesIO) -> Tuple[discord.Embed, discord.File]:
+    """
+    Creates a discord.Embed with title, description, image_name, and the image's
+    BytesIO Stream. To produce a tuple (discord.Embed, discord.File)
+    """
+    embed = create_embed(title, description)
+    return (embed, set_embed_image(embed, image_name, file_stream))
+
 
-# create PixivModule
-pixiv = PixivModule(pixiv_username, pixiv_password,
-                    cred.write_refresh_token,
-                    refresh_token=pixiv_refresh).get_client()
+def page_count(results: DeepSearch) -> str:
+    """Number of loaded results, marked with a + while more can be loaded"""
+    return f"{len(results)}{'' if results.exhausted else '+'}"
 
-client = commands.Bot(command_prefix=cmd_pref)
-client.remove_command('help')
 
 
-@client.event
-async def on_ready():
-    print(f"{client.user.name} has connected to discord.")
-    activity = discord.Activity(type=discord.ActivityType.watching, name=f'prefix {cmd_pref}')
-    await client.change_presence(activity=activity)
+# open cogs, whose caches the hit ratio gauge reports; weak so a cog
+# that was not closed can still be collected
+_cogs: 'weakref.WeakSet[PixivCog]' = weakref.WeakSet()
+_cog_ids = itertools.count()
 
-    # create check authentication loop task
-    client.loop.create_task(check_auth())
 
+def cache_hit_ratios() -> Dict[Tuple[str, str], float]:
+    """Hit ratio of every cache of every open cog, by cog and cache"""
+    ratios = {}
+    for cog in list(_cogs):
+        for (cache,), ratio in cog.cache_hit_ratios().items():
+            ratios[(str(cog.instance), cache)] = ratio
+    return ratios
 
 
-@client.command(name='test')
-async def test(ctx, *, query):
-    await ctx.send('test')
+REGISTRY.register(CallbackGauge('pixiv_bot_cache_hit_ratio',
+                                'Hit ratio of each cache since start up',
+                                ('bot', 'cache'), cache_hit_ratios))
 
 
-INTERVAL = 15 * 60
+class PixivCog(commands.Cog, name='Pixiv'):
+    """
+    Commands and reaction sessions of one bot instance, with the caches and
+    the pixiv client they share.
+        - nothing is read or connected when the module is imported; the
+          caches are built from settings here and pixiv is logged in to by
+          login()
+        - commands wait for the login, so the bot can connect to discord
+          while pixiv authenticates
+    """
 
-async def check_auth():
-    while True:
-        await asyncio.sleep(INTERVAL)
+    def __init__(self, bot: commands.Bot, settings: Settings) -> None:
+        self.bot = bot
+        self.settings = settings
+
+        # tokens and caches shared with the other worker processes,
+        # disabled with an empty shared_store_path
+        self.shared_store = None
+        if settings.shared_store_path:
+            self.shared_store = SharedStore(settings.shared_store_path)
+
+        # create image cache, disabled with image_cache_max_mb = 0
+        self.image_cache = None
+        if settings.image_cache_max_mb > 0 and self.shared_store is not None:
+            self.image_cache = SharedImageCache(settings.image_cache_dir,
+                                                settings.image_cache_max_mb * 1024 * 1024,
+                                                self.shared_store)
+        elif settings.image_cache_max_mb > 0:
+            self.image_cache = ImageCache(settings.image_cache_dir,
+                                          settings.image_cache_max_mb * 1024 * 1024)
+
+        # create image recompression pool, image_workers = 0 uses every core
+        self.image_processor = ImageProcessor(settings.image_workers or None)
+
+        # create API response cache
+        if self.shared_store is not None:
+            self.metadata_cache = SharedMetadataCache(settings.metadata_cache_max_entries,
+                                                      METADATA_TTL, self.shared_store)
+        else:
+            self.metadata_cache = MetadataCache(settings.metadata_cache_max_entries,
+                                                METADATA_TTL)
+
+        # resolves search tags to pixiv tags
+        self.tag_matcher = TagMatcher(settings.tag_match_threshold, settings.tag_cache_entries)
+
+        # create local tag dictionary, disabled with an empty tag_store_path
+        self.tag_store = None
+        if settings.tag_store_path:
+            self.tag_store = TagStore(settings.tag_store_path,
+                                      settings.tag_store_max_age_days * 24 * 60 * 60)
+
+        # routes reactions to the open galleries
+        self.dispatcher = ReactionDispatcher()
+
+        # saved galleries, revived when reacted to after they left memory;
+        # disabled with an empty session_store_path
+        self.session_store = None
+        if settings.session_store_path:
+            self.session_store = SessionStore(settings.session_store_path,
+                                              settings.session_max_age_hours * 60 * 60)
+        self._reviving: Dict[int, asyncio.Future] = {}
+
+        # set once login() completes
+        self.pixiv = None
+        self._login = None
+
+        # serves REGISTRY when metrics_port is set
+        self.metrics_runner = None
+
+        # labels this cog's series of the cache hit ratio gauge
+        self.instance = next(_cog_ids)
+        _cogs.add(self)
+
+    def cache_hit_ratios(self) -> Dict[Tuple[str], float]:
+        ratios = {('metadata',): self.metadata_cache.stats()['hit_ratio'],
+                  ('tags',): self.tag_matcher.stats()['hit_ratio']}
+        if self.image_cache is not None:
+            ratios[('image',)] = self.image_cache.hit_ratio()
+        return ratios
+
+    def login(self) -> 'asyncio.Future[AsyncExtendedClient]':
+        """
+        Logs in to pixiv, again only if the last attempt failed. PixivModule authenticates synchronously, so
+        it runs in an executor and the event loop keeps serving discord.
+
+        :return: A future of the logged in client, shared by every caller
+        """
+        if self._login is None or (self._login.done() and
+                                   (self._login.cancelled() or self._login.exception())):
+            self._login = asyncio.ensure_future(self._log_in())
+        return self._login
+
+    async def _log_in(self) -> AsyncExtendedClient:
+        settings = self.settings
+        loop = asyncio.get_event_loop()
+        with stage('pixiv:login'):
+            module = await loop.run_in_executor(None, functools.partial(
+                PixivModule, settings.pixiv_username, settings.pixiv_password,
+                settings.credentials.write_refresh_token,
+                refresh_token=settings.pixiv_refresh,
+                token_store=self.shared_store))
+
+        self.pixiv = module.get_async_client(
+            max_downloads=settings.max_downloads,
+            max_downloads_per_illust=settings.max_downloads_per_illust,
+            image_cache=self.image_cache,
+            metadata_cache=self.metadata_cache,
+            max_download_bytes=settings.max_download_mb * 1024 * 1024,
+            rate_share=settings.rate_share)
+
+        # keep the pixiv access token fresh
+        self.pixiv.tokens.start()
+        return self.pixiv
+
+    async def close(self) -> None:
+        """Stops the background tasks and releases the clients and caches"""
+        _cogs.discard(self)
+        self.dispatcher.stop()
+        for session in list(self.dispatcher.sessions.values()):
+            await self.dispatcher.end(session)
+
+        if self._login is not None and not self._login.done():
+            self._login.cancel()
+        if self.pixiv is not None:
+            self.pixiv.tokens.stop()
+            await self.pixiv.close()
+
+        if self.metrics_runner is not None:
+            await self.metrics_runner.cleanup()
+            self.metrics_runner = None
+
+        self.image_processor.shutdown()
+        if self.tag_store is not None:
+            self.tag_store.close()
+        if self.shared_store is not None:
+            self.shared_store.close()
+        if self.session_store is not None:
+            self.session_store.close()
+
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        client = self.bot
+        print(f"{client.user.name} has connected to discord.")
+        activity = discord.Activity(type=discord.ActivityType.watching,
+                                    name=f'prefix {self.settings.command_prefix}')
+        await client.change_presence(activity=activity)
+
+        # start expiring reaction sessions
+        self.dispatcher.start()
+
+        settings = self.settings
+        if settings.metrics_port and self.metrics_runner is None:
+            self.metrics_runner = await serve(REGISTRY, settings.metrics_host,
+                                              settings.metrics_port)
+
+
+
+    def is_bot(self, user_id: int, member=None) -> bool:
+        """Whether user_id is a bot, including this one"""
+        if user_id == self.bot.user.id:
+            return True
+        user = member or self.bot.get_user(user_id)
+        return user is not None and user.bot
+
+    def can_remove_reactions(self, channel_id: int) -> bool:
+        """Whether the bot may remove other users' reactions in the channel"""
+        channel = self.bot.get_channel(channel_id)
+        if not isinstance(channel, discord.abc.GuildChannel):
+            return False
+        return channel.permissions_for(channel.guild.me).manage_messages
+
+    async def remove_reaction(self, payload) -> None:
+        """Takes back a user's reaction, so clicking it again adds it again"""
+        try:
+            await self.bot.http.remove_reaction(payload.channel_id, payload.message_id,
+                                                str(payload.emoji), payload.user_id)
+        except discord.HTTPException as err:
+            print(f'Removing reaction from message {payload.message_id} failed: {err}')
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_add(self, payload):
+        # ignore reactions of bots, including the ones we add ourselves
+        if self.is_bot(payload.user_id, payload.member):
+            return
+        await self.handle_reaction(payload)
+
+    @commands.Cog.listener()
+    async def on_raw_reaction_remove(self, payload):
+        # where the bot cannot take back clicked arrows, see handle_reaction,
+        # taking one back is a click too
+        if (str(payload.emoji) in (LEFT_ARROW, RIGHT_ARROW) and
+                not self.is_bot(payload.user_id) and
+                not self.can_remove_reactions(payload.channel_id)):
+            await self.handle_reaction(payload)
+
+    async def handle_reaction(self, payload):
+        """Dispatches a user's reaction event to the session of its message"""
+        if payload.message_id not in self.dispatcher.sessions:
+            # only gallery controls are worth a look in the session store
+            if (str(payload.emoji) not in (LEFT_ARROW, RIGHT_ARROW, HEART, DOWNLOAD) or
+                    await self.revive_session(payload.message_id,
+                                              payload.channel_id) is None):
+                return
+
+        # page flips edit the message in place, which would leave the arrow
+        # clicked and make the next click on it a removal
+        if (payload.event_type == 'REACTION_ADD' and
+                str(payload.emoji) in (LEFT_ARROW, RIGHT_ARROW) and
+                self.can_remove_reactions(payload.channel_id)):
+            asyncio.ensure_future(self.remove_reaction(payload))
+
+        trace = Trace('reaction') if 'reaction' in self.settings.trace_commands else None
+        token = current_trace.set(trace)
         try:
-            pixiv.search_popular('rem')
+            with stage('reaction'):
+                await self.dispatcher.dispatch(payload.message_id, str(payload.emoji),
+                                               payload.user_id)
+        finally:
+            current_trace.reset(token)
+            if trace is not None:
+                print(trace.format())
+
+
+    async def cog_before_invoke(self, ctx):
+        """
+        Waits for the pixiv login, then starts timing the command, and
+        tracing it if it is in trace_commands
+        """
+        await self.login()
+
+        ctx.started = time.perf_counter()
+        STAGE_IN_FLIGHT.inc(stage=f'command:{ctx.command.name}')
+        if ctx.command.name in self.settings.trace_commands:
+            current_trace.set(Trace(ctx.command.name))
+
+
+    async def cog_after_invoke(self, ctx):
+        name = f'command:{ctx.command.name}'
+        STAGE_IN_FLIGHT.dec(stage=name)
+        STAGE_SECONDS.observe(time.perf_counter() - ctx.started, stage=name)
+
+        trace = current_trace.get()
+        if trace is not None:
+            print(trace.format())
+            current_trace.set(None)
+
+
+
+    async def save_session(self, session: 'MessageSession',
+                           previous_id: Optional[int] = None) -> None:
+        """
+        Saves the illustrations and page of session, under the id of the
+        message it now shows.
+
+        :param int previous_id: Id of the message session showed before, if
+            it had to be resent.
+        """
+        if self.session_store is None:
+            return
+
+        message = session.message
+        saved = SavedSession(message.id, message.channel.id, session.kind,
+                             [illust.id for illust in session.illusts],
+                             session.curr_page, 0.0)
+        new_illusts = session.illusts[session.saved_illusts:]
+
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.run_in_executor(None, functools.partial(
+                self.session_store.save, saved, new_illusts, previous_id))
+            session.saved_illusts += len(new_illusts)
         except Exception as err:
-            print('Exception Raised in check_auth()')
+            print('Failed to save session')
             print(err)
-            # attempt to reauthenticate
-            pixiv.authenticate(pixiv_refresh)
 
+    async def revive_session(self, message_id: int,
+                             channel_id: int) -> Optional['MessageSession']:
+        """
+        Rebuilds the session of message_id from the session store and
+        registers it. Reactions arriving while it is rebuilt share the
+        revival.
+
+        :return: The session, None if none was saved or it expired
+        """
+        if self.session_store is None:
+            return None
+
+        future = self._reviving.get(message_id)
+        if future is None:
+            future = asyncio.ensure_future(self._revive(message_id, channel_id))
+            future.add_done_callback(lambda _: self._reviving.pop(message_id, None))
+            self._reviving[message_id] = future
+
+        try:
+            return await asyncio.shield(future)
+        except Exception as err:
+            print(f'Failed to revive session of message {message_id}')
+            print(err)
+            return None
 
-@client.command(name='help')
-async def help(ctx):
-    embed=discord.Embed(title="pixiv-bot Help Page", color=0xff6b6b)
-    embed.add_field(name="Commands",
-                    value="""`?search tag1, tag2, ...` Searches pixiv.net
-                    for the top 30 most popular illustrations associated
-                    with the tags. Enter tags seperated by commas.""",
-                    inline=False)
-    
-    embed.add_field(name="Reaction System",
-                    value=f"""
-                            - React to {LEFT_ARROW} to go back to the previous panel/image.
-                            - React to {RIGHT_ARROW} to go to the next panel/image. 
-                            - React to {HEART} to find 3 related images. 
-                            - React to {DOWNLOAD} to get the full quality images.
-                          """,
-                    inline=False)
-    await ctx.send(embed=embed)
+    async def _revive(self, message_id: int, channel_id: int) -> Optional['MessageSession']:
+        loop = asyncio.get_event_loop()
+        loaded = await loop.run_in_executor(None, self.session_store.load, message_id)
+        if loaded is None:
+            return None
+        saved, illusts = loaded
 
+        await self.login()
+        try:
+            channel = (self.bot.get_channel(channel_id) or
+                       await self.bot.fetch_channel(channel_id))
+            message = await channel.fetch_message(message_id)
+        except (discord.NotFound, discord.Forbidden):
+            # the message is gone or out of reach for good
+            await loop.run_in_executor(None, self.session_store.delete, message_id)
+            return None
+        ctx = await self.bot.get_context(message)
+        embed = message.embeds[0] if message.embeds else create_embed('', '')
+
+        if saved.kind == SearchSession.kind:
+            results = DeepSearch.finished(illusts)
+            pager = SearchResultPager(self.pixiv, results.illusts,
+                                      size=self.settings.search_preview_size)
+            session = SearchSession(self, ctx, message, embed, results, pager)
+        else:
+            pages = LazyPageSource(self.pixiv, illusts[0],
+                                   size=self.settings.gallery_preview_size)
+            session = GallerySession(self, ctx, message, embed, illusts[0], pages)
 
-# max download size
-FILE_SIZE_MAX = 7900000
+        session.curr_page = saved.page
+        session.saved_illusts = len(illusts)
+        self.dispatcher.register(session)
+        return session
 
-IMAGE_QUALITY = 85
 
-def process_image(image_buffer: io.BytesIO) -> io.BytesIO:
+    @commands.command(name='test')
+    async def test(self, ctx, *, query):
+        await ctx.send('test')
 
-    if image_buffer.getbuffer().nbytes < FILE_SIZE_MAX:
-        return image_buffer
 
-    image_buffer.seek(0)
-    image = Image.open(image_buffer)
-    
-    new_buffer = io.BytesIO()
-    image.save(new_buffer, format='JPEG', quality=IMAGE_QUALITY)
+    @commands.command(name='cache_stats')
+    async def cache_stats(self, ctx):
+        meta = self.metadata_cache.stats()
+        tags = self.tag_matcher.stats()
+        lines = [f"metadata cache: {meta['hits']} hits, {meta['misses']} misses "
+                 f"({meta['hit_ratio']:.0%}), {meta['entries']} entries",
+                 f"tag cache: {tags['hits']} hits, {tags['misses']} misses "
+                 f"({tags['hit_ratio']:.0%}), {tags['entries']} entries"]
 
-    new_buffer.seek(0)
-    return new_buffer
+        if self.image_cache is None:
+            lines.append('image cache: disabled')
+        else:
+            # the shared cache's size is read from its store
+            loop = asyncio.get_event_loop()
+            stats = await loop.run_in_executor(None, self.image_cache.stats)
+            lines.append(f"image cache: {stats['hits']} hits, {stats['misses']} misses "
+                         f"({stats['hit_ratio']:.0%}), {stats['entries']} files, "
+                         f"{stats['bytes'] / 1024 / 1024:.1f} MB")
+
+        newline = '\n'
+        await ctx.send(f'```{newline.join(lines)}```')
+
+
+    @commands.command(name='help')
+    async def help(self, ctx):
+        embed=discord.Embed(title="pixiv-bot Help Page", color=0xff6b6b)
+        embed.add_field(name="Commands",
+                        value="""`?search tag1, tag2, ...` Searches pixiv.net
+                        for the top 30 most popular illustrations associated
+                        with the tags. Enter tags seperated by commas.""",
+                        inline=False)
+
+        embed.add_field(name="Reaction System",
+                        value=f"""
+                                - React to {LEFT_ARROW} to go back to the previous panel/image.
+                                - React to {RIGHT_ARROW} to go to the next panel/image.
+                                - React to {HEART} to find 3 related images.
+                                - React to {DOWNLOAD} to get the full quality images.
+                              """,
+                        inline=False)
+        await ctx.send(embed=embed)
+
+
+    @commands.command(name='download')
+    async def download(self, ctx, illust_id: int):
+        pixiv = self.pixiv
+
+        # trigger typing
+        await ctx.trigger_typing()
 
-    
+        try:
+            illust = await pixiv.fetch_illustration(illust_id)
 
+            # originals over max_download_mb are replaced by the large version
+            results = await pixiv.get_illust_byte_streams(illust, size=Size.ORIGINAL,
+                                                          return_exceptions=True,
+                                                          fallback_size=Size.LARGE)
 
-@client.command(name='download')
-async def download(ctx, illust_id: int):
+            # report pages that failed to download
+            failed = [index for index, result in enumerate(results)
+                      if isinstance(result, BaseException)]
+            file_streams = {index: result for index, result in enumerate(results)
+                            if index not in failed}
 
-    # trigger typing
-    await ctx.trigger_typing()
-    
-    try:
-        illust = pixiv.fetch_illustration(illust_id)
+            if failed:
+                pages = ', '.join(str(index + 1) for index in failed)
+                await ctx.send(f'Failed to download page(s) {pages}.')
+                print(f'download({illust_id}) failed pages: {failed}')
 
-        file_streams = pixiv.get_illust_byte_streams(illust, size=Size.ORIGINAL)
+            if not file_streams:
+                return
 
-        # check for oversized files
-        num_of_large = len([buffer
-                            for buffer in file_streams
-                            if buffer.getbuffer().nbytes > FILE_SIZE_MAX])
+            # check for oversized files
+            num_of_large = len([buffer
+                                for buffer in file_streams.values()
+                                if buffer.getbuffer().nbytes > FILE_SIZE_MAX])
 
-        if num_of_large:
-            await ctx.send(f'There are {num_of_large} file(s) that are over 8MBs. Performing compressions.')
+            if num_of_large:
+                await ctx.send(f'There are {num_of_large} file(s) that are over 8MBs. Performing compressions.')
 
-        # DEBUG:
-        image_binaries = [process_image(x) for x in file_streams]
+            # DEBUG:
+            image_binaries = dict(zip(file_streams.keys(),
+                                      await self.image_processor.process_images(
+                                          list(file_streams.values()))))
 
-        # send images as attachments
-        await ctx.send(files=[discord.File(fp=stream,
-                                           filename=f'{illust.id}_{index}.jpg')
-                              for index, stream in enumerate(image_binaries)])
+            # send images as attachments
+            await send_message(ctx, files=[discord.File(fp=stream,
+                                               filename=f'{illust.id}_{index}.jpg')
+                                  for index, stream in image_binaries.items()])
 
-        
-    except Exception as err:
-        await ctx.send('Failed to download.')
-        print(err)
 
+        except Exception as err:
+            await ctx.send('Failed to download.')
+            print(err)
 
-    
 
-THRESHOLD = 0.5
 
-@client.command(name='search')
-async def search(ctx, *, query: str):
 
-    #trigger typing
-    await ctx.trigger_typing()
-    
-    def find_best_tag(query: str, query_item: Dict[str, str]) -> Tuple[str, float]:
-        def calc_max_ratio(query: str, query_item: Dict[str, str]) -> float:
-            eng_tag = query_item['translated_name']
-            jap_tag = query_item['name']
+    async def resolve_tag(self, tag: str) -> str:
+        """
+        Resolves tag to the best matching pixiv tag, falls back to the raw tag
+        if there is no confident match
+        """
+        tag_matcher, tag_store = self.tag_matcher, self.tag_store
 
-            eng_ratio = ratio(query.lower(), str(eng_tag).lower())
-            jap_ratio = ratio(query.lower(), str(jap_tag).lower())
+        resolved = tag_matcher.get(tag)
+        if resolved is not None:
+            return resolved
 
-            return max(eng_ratio, jap_ratio)
+        loop = asyncio.get_event_loop()
+        if tag_store is not None:
+            answered, candidates = await loop.run_in_executor(None, tag_store.lookup, tag)
+            if answered is not None:
+                return tag_matcher.resolve(tag, answered)
 
-        best_item = max(tag_suggestions, key=lambda x: calc_max_ratio(query, x))
-        return (best_item['name'], calc_max_ratio(query, best_item))
-    
-    
-    tag_list = query.split(',')
-    tag_result = []
+            # a query naming a stored tag resolves to it, anything merely
+            # similar may not be what the API suggests, e.g. rem vs remilia
+            if candidates:
+                return tag_matcher.remember(tag, candidates[0]['name'])
 
-    #DEBUG:
-    #await ctx.send(f'```{tag_list}```')
-    
+        tag_suggestions = await asyncio.wait_for(self.pixiv.search_autocomplete(tag),
+                                                 timeout=TAG_TIMEOUT)
+        if tag_store is not None:
+            await loop.run_in_executor(None, tag_store.add, tag, tag_suggestions)
+        return tag_matcher.resolve(tag, tag_suggestions)
 
-    for tag in tag_list:
-        tag_suggestions = pixiv.search_autocomplete(tag.strip())
 
-        # create query for only valid tags
-        if tag_suggestions:
-            best, confidence = find_best_tag(tag, tag_suggestions)
+    async def resolve_tags(self, tag_list: List[str]) -> List[str]:
+        """
+        Resolves every tag concurrently, results are in input order. Tags that
+        fail or time out are kept as is.
+        """
+        tag_list = [tag.strip() for tag in tag_list]
+        results = await asyncio.gather(*[self.resolve_tag(tag) for tag in tag_list],
+                                       return_exceptions=True)
 
-            if confidence < THRESHOLD:
+        tag_result = []
+        for tag, result in zip(tag_list, results):
+            if isinstance(result, Exception):
+                print(f'Failed to resolve tag {tag!r}: {result!r}')
                 tag_result.append(tag)
             else:
-                tag_result.append(best)
-        else:
-            tag_result.append(tag.strip())
+                tag_result.append(result)
 
-    # generate api query tags
-    compiled_query = ' '.join(tag_result)
-    query_display = ' '.join(map(lambda x: f'`#{x}`', tag_result))
+        return tag_result
 
-    #DEBUG:
-    #await ctx.send(f'```{compiled_query}```')
 
-    # get illustrations
-    # TODO: Change to pixiv.search_popular() 
-    #res = pixiv.search_popular_preview(compiled_query, search_target=SearchTarget.TAGS_PARTIAL)
-    res = pixiv.search_popular_preview(compiled_query) # use exact tag matching
+    @commands.command(name='search')
+    async def search(self, ctx, *, query: str):
+        pixiv = self.pixiv
 
-    illusts = res['illustrations'] # array of Illustrations
+        #trigger typing
+        await ctx.trigger_typing()
 
-    curr_page = 0
-    pages_total = len(illusts)
+        tag_list = query.split(',')
 
-    # create gallery embed
-    preview = pixiv.get_illust_byte_streams(illusts[curr_page])[0]
+        #DEBUG:
+        #await ctx.send(f'```{tag_list}```')
 
-    embed, file = create_embed_file('Search Results',
-                                    f'tags: {query_display}',
-                                    illusts[curr_page].id,
-                                    preview)
-    embed.set_footer(text=f'Page {curr_page+1}/{pages_total} id: {illusts[curr_page].id}')
-    
-    message = await ctx.send(embed=embed, file=file)
+        tag_result = await self.resolve_tags(tag_list)
 
-    # add reactions
-    await add_reactions(message)
+        # generate api query tags
+        compiled_query = ' '.join(tag_result)
+        query_display = ' '.join(map(lambda x: f'`#{x}`', tag_result))
 
+        #DEBUG:
+        #await ctx.send(f'```{compiled_query}```')
 
-    # implements the reaction to controls
-    def check(reaction, user):
-        return not user.bot and reaction.message == message
-    
-    while True:
+        # get illustrations, further pages are fetched as the user pages on
+        results = DeepSearch(pixiv.search_popular_pages(compiled_query,
+                                                        search_target=SearchTarget.TAGS_EXACT),
+                             rank_pages=self.settings.search_rank_pages)
         try:
-            reaction, user = await client.wait_for('reaction_add', timeout=TIMEOUT,
-                                                   check=check)
-            if reaction.emoji == LEFT_ARROW and pages_total > 1:
-                #trigger typing
-                await ctx.trigger_typing()
-                
-                # calc new page
-                curr_page = curr_page - 1
-                if curr_page < 0:
-                    curr_page = pages_total - 1
-
-                # edit gallery embed
-                preview = pixiv.get_illust_byte_streams(illusts[curr_page])[0]
-
-                embed, file = create_embed_file('Search Results',
-                                                f'tags: {query_display}',
-                                                illusts[curr_page].id,
-                                                preview)
-                embed.set_footer(text=f'Page {curr_page+1}/{pages_total} id: {illusts[curr_page].id}')
-
-                await message.delete()
-                message = await ctx.send(embed=embed, file=file)
-
-                # add reactions
-                await add_reactions(message)
-                
-                
-            if reaction.emoji == RIGHT_ARROW and pages_total > 1:
-                #trigger typing
-                await ctx.trigger_typing()
-                
-                # calc new page
-                curr_page = (curr_page + 1) % pages_total
-
-                # edit gallery embed
-                preview = pixiv.get_illust_byte_streams(illusts[curr_page])[0]
-
-                embed, file = create_embed_file('Search Results for',
-                                                f'tags: {query_display}',
-                                                illusts[curr_page].id,
-                                                preview)
-                embed.set_footer(text=f'Page {curr_page+1}/{pages_total} id: {illusts[curr_page].id}')
-
-                await message.delete()
-                message = await ctx.send(embed=embed, file=file)
-
-                # add reactions
-                await add_reactions(message)
-
-
-            if reaction.emoji == HEART:
-                # trigger typing
-                await ctx.trigger_typing()
-                await ctx.invoke(client.get_command('search_related'),
-                                 illust_id=illusts[curr_page].id)
-
-            if reaction.emoji == DOWNLOAD:
-                # invoke download command
-                await ctx.invoke(client.get_command('download'),
-                                 illust_id=illusts[curr_page].id)
-            
-        except asyncio.TimeoutError:
-            break
-        except Exception as err:
-            print("Something else went wrong")
-            print(err)
-            break
-            
-    
+            first = await results.get(0)
+        except Exception:
+            await results.close()
+            raise
 
-@client.command(name='get_tag_popular_result')
-async def get_tag_popular_result(ctx, *, query: str):
+        # check if query is empty
+        if first is None:
+            await results.close()
+            await ctx.send("No result found.")
+            return
 
-    res = pixiv.search_popular_preview(query)
+        pager = SearchResultPager(pixiv, results.illusts,
+                                  size=self.settings.search_preview_size)
 
-    content = ""
+        try:
+            # create gallery embed
+            preview = await pager.get(0)
 
-    for illust in res['illustrations']:
-        content += f'{illust.id} -> {illust.title} {illust.total_bookmarks}' + '\n'
+            embed, file = create_embed_file('Search Results',
+                                            f'tags: {query_display}',
+                                            first.id,
+                                            preview)
+            embed.set_footer(text=f'Page 1/{page_count(results)} id: {first.id}')
 
-    await ctx.send(f'```{content}```')
+            message = await send_message(ctx, embed=embed, file=file)
+        except Exception:
+            pager.close()
+            await results.close()
+            raise
 
+        session = SearchSession(self, ctx, message, embed, results, pager)
+        self.dispatcher.register(session)
+        session.upgrade_preview()
+        await self.save_session(session)
 
-#FIRST_CAPTURE = 10
+        # add reactions
+        await add_reactions(message)
 
-@client.command(name='search_related')
-async def search_related(ctx, illust_id:int, number=3):
-    
-    #trigger typing
-    await ctx.trigger_typing()
 
-    # query related images
-    res = pixiv.fetch_illustration_related(illust_id)
-    related = res['illustrations']
+    @commands.command(name='get_tag_popular_result')
+    async def get_tag_popular_result(self, ctx, *, query: str):
 
-    """
-    sorted(res['illustrations'][:FIRST_CAPTURE],
-                     key=lambda work: work.total_bookmarks,
-                     reverse=True)
-    """
+        res = await self.pixiv.search_popular_preview(query)
 
-    # check if query is empty
-    if not related:
-        await ctx.send("No result found.")
-        return
-    
+        content = ""
 
-    # send number of images as gallery
-    await asyncio.wait([
-        ctx.invoke(client.get_command('create_gallery'),
-                   illust_id=illust.id)
-        for illust in related[:number]
-        ])
+        for illust in res['illustrations']:
+            content += f'{illust.id} -> {illust.title} {illust.total_bookmarks}' + '\n'
 
+        await ctx.send(f'```{content}```')
 
 
+    #FIRST_CAPTURE = 10
 
+    @commands.command(name='search_related')
+    async def search_related(self, ctx, illust_id:int, number=3):
 
+        #trigger typing
+        await ctx.trigger_typing()
 
+        # query related images
+        res = await self.pixiv.fetch_illustration_related(illust_id)
+        related = res['illustrations']
 
-@client.command(name='search_tag')
-async def search_tag(ctx, *, tag:str):
+        """
+        sorted(res['illustrations'][:FIRST_CAPTURE],
+                         key=lambda work: work.total_bookmarks,
+                         reverse=True)
+        """
 
-    # Create Message Embed Object
-    embed=discord.Embed(title="Search Result Tags",
-                        description="Please select the the appropriate tags",
-                        color=0xff9214)
-    
-    async with ctx.typing():
-        tag_result = pixiv.search_autocomplete(tag)
+        # check if query is empty
+        if not related:
+            await ctx.send("No result found.")
+            return
 
-        if tag_result:
-            # Process the tag results
-            for index, tag_dict in enumerate(tag_result):
-                eng_tag = tag_dict['translated_name']
-                jap_tag = tag_dict['name']
-                embed.add_field(name=f"{index+1}. {jap_tag}",
-                                value=eng_tag,
-                                inline=False)
 
-        else:
-            embed.description = ""
-            embed.add_field(name="No result found",
-                                value="Please check the tag again.",
-                                inline=False)
-            
-        
-    # Send Embeded Message
-    await ctx.send(embed=embed)
-        
-
-    
-    
-"""
-@search_tag.error
-async def search_tag_error(ctx, error):
-    if isinstance(error, commands.MissingRequiredArgument):
-        await ctx.send("Missing Arguements.")
-"""
+        # send number of images as gallery
+        await asyncio.wait([
+            asyncio.ensure_future(ctx.invoke(self.create_gallery, illust_id=illust.id))
+            for illust in related[:number]
+            ])
 
-TIMEOUT = 30.0
 
 
-def create_embed_file(title: str,
-                      description: str,
-                      image_name:str,
-                      file_stream: io.BytesIO) -> Tuple[discord.Embed, discord.File]:
-    """
-    Creates a discord.Embed with title, description, image_name, and the image's
-    BytesIO Stream. To produce a tuple (discord.Embed, discord.File) 
-    """
-    caption = re.sub('<[^<]+?>', '', description)
-    caption = re.sub('http\S+', '', caption)
-    embed = discord.Embed(title=title, description=caption, color=0x00cec9)
-    embed.set_image(url=f"attachment://{image_name}.jpg")
 
-    # reset image byte stream back to 0
-    file_stream.seek(0)
-    file = discord.File(fp=file_stream, filename=f"{image_name}.jpg")
 
-    return (embed, file)
+
+
+    @commands.command(name='search_tag')
+    async def search_tag(self, ctx, *, tag:str):
+
+        # Create Message Embed Object
+        embed=discord.Embed(title="Search Result Tags",
+                            description="Please select the the appropriate tags",
+                            color=0xff9214)
+
+        async with ctx.typing():
+            tag_result = await self.pixiv.search_autocomplete(tag)
+
+            if tag_result:
+                # Process the tag results
+                for index, tag_dict in enumerate(tag_result):
+                    eng_tag = tag_dict['translated_name']
+                    jap_tag = tag_dict['name']
+                    embed.add_field(name=f"{index+1}. {jap_tag}",
+                                    value=eng_tag,
+                                    inline=False)
+
+            else:
+                embed.description = ""
+                embed.add_field(name="No result found",
+                                    value="Please check the tag again.",
+                                    inline=False)
+
+
+        # Send Embeded Message
+        await ctx.send(embed=embed)
+
 
 
 
-@client.command(name='create_gallery')
-async def create_gallery(ctx, illust_id:int):
     """
-    TODO: Attempts to open file in image_cache
-           - if does not exists, download the images
-           - if images has multiple panels download as id_p{panel_number}.{ext}
-          After react period expires after 30 seconds, images are optionally purged
-     - preview images uses Size.LARGE (for now)
+    @search_tag.error
+    async def search_tag_error(ctx, error):
+        if isinstance(error, commands.MissingRequiredArgument):
+            await ctx.send("Missing Arguements.")
     """
 
-    #trigger typing
-    await ctx.trigger_typing()
 
-    illust = pixiv.fetch_illustration(illust_id)
-    image_binaries = pixiv.get_illust_byte_streams(illust)
+    @commands.command(name='create_gallery')
+    async def create_gallery(self, ctx, illust_id:int):
+        """
+         - images are read from image_cache when present, otherwise downloaded
+           and stored as {id}_p{panel_number}_{size}
+         - pages are downloaded lazily when first shown, the next page in the
+           direction of travel is prefetched, and all pages are dropped when the
+           react period expires
+         - pages are shown in gallery_preview_size first and upgraded to
+           Size.LARGE once the user stays on a page
+        """
+
+        #trigger typing
+        await ctx.trigger_typing()
 
-    pages_total = len(image_binaries)
-    curr_page = 0 # index starts at 0 -> display + 1
+        illust = await self.pixiv.fetch_illustration(illust_id)
+        pages = LazyPageSource(self.pixiv, illust, size=self.settings.gallery_preview_size)
+
+        try:
+            # multi page illustration
+            embed, file = create_embed_file(illust.title,
+                                            illust.caption,
+                                            f"{illust.id}_p0",
+                                            await pages.get(0))
+            embed.set_footer(text=f'Page Index 1/{len(pages)}  id: {illust.id}')
+            message = await send_message(ctx, file=file, embed=embed)
+        except Exception:
+            pages.close()
+            raise
+
+        session = GallerySession(self, ctx, message, embed, illust, pages)
+        self.dispatcher.register(session)
+        session.upgrade_preview()
+        await self.save_session(session)
+
+        # add reaction emojis
+        await add_reactions(message)
 
 
-    # multi page illustration
-    embed, file = create_embed_file(illust.title,
-                                    illust.caption,
-                                    f"{illust.id}_p{curr_page}",
-                                    image_binaries[curr_page])
-    embed.set_footer(text=f'Page Index {curr_page+1}/{pages_total}  id: {illust.id}')
-    message = await ctx.send(file=file, embed=embed)
 
-    # add reaction emojis
-    await add_reactions(message)
-    
-    # implements the reaction to controls
+class MessageSession(ReactionSession):
+    """
+    A reaction session of a message sent in reply to ctx. Subclasses keep
+    the shown page in `curr_page`, the message's embed in `embed` and the
+    illustrations they show in `illusts`; `kind` tells them apart in the
+    session store.
+    """
 
-    def check(reaction, user):
-        return not user.bot and reaction.message == message
-    
-    while True:
+    kind = ''
+
+    def __init__(self, cog: PixivCog, ctx, message) -> None:
+        super().__init__(message, TIMEOUT)
+        self.cog = cog
+        self.ctx = ctx
+        self.curr_page = 0
+        # leading illusts already in the session store
+        self.saved_illusts = 0
+        self._upgrade = None
+
+    def upgrade_later(self, image_name: str,
+                      load: Callable[[], Awaitable[io.BytesIO]]) -> None:
+        """
+        Replaces the image of the current page with load() if the user is
+        still on the page after preview_upgrade_delay seconds.
+        """
+        self.cancel_upgrade()
+        self._upgrade = asyncio.ensure_future(
+            self._upgrade_image(self.curr_page, image_name, load))
+
+    def cancel_upgrade(self) -> None:
+        if self._upgrade is not None and not self._upgrade.done():
+            self._upgrade.cancel()
+        self._upgrade = None
+
+    async def _upgrade_image(self, page: int, image_name: str,
+                             load: Callable[[], Awaitable[io.BytesIO]]) -> None:
         try:
-            reaction, user = await client.wait_for('reaction_add', timeout=TIMEOUT,
-                                                   check=check)
-            if reaction.emoji == LEFT_ARROW and pages_total > 1:
-                # calc new page
-                curr_page = curr_page - 1
-                if curr_page < 0:
-                    curr_page = pages_total - 1
-                
-                # edit current embed
-                embed, file = create_embed_file(illust.title,
-                                    illust.caption,
-                                    f"{illust.id}_p{curr_page}",
-                                    image_binaries[curr_page])
-                embed.set_footer(text=f'Page Index {curr_page+1}/{pages_total} id: {illust.id}')
-
-                # resend message
-                await message.delete()
-                message = await ctx.send(file=file, embed=embed)
-
-                # add reaction emojis
-                await add_reactions(message)
-
-
-            if reaction.emoji == RIGHT_ARROW and pages_total > 1:
-                # calc new page
-                curr_page = (curr_page + 1) % pages_total
-
-                # edit current embed
-                embed, file = create_embed_file(illust.title,
-                                    illust.caption,
-                                    f"{illust.id}_p{curr_page}",
-                                    image_binaries[curr_page])
-                embed.set_footer(text=f'Page Index {curr_page+1}/{pages_total} id: {illust.id}')
-
-                # resend message
-                await message.delete()
-                message = await ctx.send(file=file, embed=embed)
-
-                # add reaction emojis
-                await add_reactions(message)
-
-            if reaction.emoji == HEART:
-                await ctx.invoke(client.get_command('search_related'),
-                                 illust_id=illust.id)
-
-            if reaction.emoji == DOWNLOAD:
-                # invoke download command
-                await ctx.invoke(client.get_command('download'),
-                                 illust_id=illust.id)
-            
-        except asyncio.TimeoutError:
-            break
+            await asyncio.sleep(self.cog.settings.preview_upgrade_delay)
+            stream = await load()
+
+            async with self.lock:
+                # the user moved on, or the session ended meanwhile
+                if (self.curr_page != page or
+                        self.cog.dispatcher.sessions.get(self.message.id) is not self):
+                    return
+                file = set_embed_image(self.embed, image_name, stream)
+                await self.replace_message(self.embed, file)
+        except asyncio.CancelledError:
+            raise
         except Exception as err:
-            print("Something else went wrong")
+            print('Failed to upgrade preview')
             print(err)
-            break
 
-            
+    async def replace_message(self, embed: discord.Embed, file: discord.File) -> None:
+        """Shows a new page, following the message if it had to be resent"""
+        old_id = self.message.id
+        self.message = await replace_message(self.ctx, self.message, embed, file)
+        if self.message.id != old_id:
+            self.cog.dispatcher.rekey(old_id, self)
+            await self.cog.save_session(self, previous_id=old_id)
+        else:
+            await self.cog.save_session(self)
+
+
+class SearchSession(MessageSession):
+    """Reaction controls of a search result gallery"""
+
+    kind = 'search'
+
+    def __init__(self, cog: PixivCog, ctx, message, embed: discord.Embed,
+                 results: DeepSearch, pager: SearchResultPager) -> None:
+        super().__init__(cog, ctx, message)
+        self.embed = embed
+        self.results = results
+        self.illusts = results.illusts
+        self.pager = pager
+
+    def upgrade_preview(self) -> None:
+        """Swaps in the full size preview once the user stays on the page"""
+        if self.pager.size == UPGRADE_SIZE:
+            return
+        illust = self.illusts[self.curr_page]
+        self.upgrade_later(illust.id, functools.partial(
+            download_page, self.cog.pixiv, illust, 0, UPGRADE_SIZE, Priority.PREFETCH))
+
+    async def show_page(self, title: str) -> None:
+        curr_page = self.curr_page
+
+        # swap the image and footer of the gallery embed
+        preview = await self.pager.get(curr_page)
+
+        self.embed.title = title
+        file = set_embed_image(self.embed, self.illusts[curr_page].id, preview)
+        self.embed.set_footer(text=f'Page {curr_page+1}/{page_count(self.results)} '
+                                   f'id: {self.illusts[curr_page].id}')
+
+        await self.replace_message(self.embed, file)
+        self.upgrade_preview()
 
+    async def on_reaction(self, emoji: str, user_id: int) -> None:
+        ctx = self.ctx
+        more = not self.results.exhausted
 
+        if emoji == LEFT_ARROW and len(self.illusts) > 1:
+            #trigger typing
+            await ctx.trigger_typing()
 
+            # calc new page
+            self.curr_page = self.curr_page - 1
+            if self.curr_page < 0:
+                self.curr_page = len(self.illusts) - 1
 
+            await self.show_page('Search Results')
 
+        if emoji == RIGHT_ARROW and (len(self.illusts) > 1 or more):
+            #trigger typing
+            await ctx.trigger_typing()
 
+            # calc new page, loading the next results past the last one
+            if await self.results.get(self.curr_page + 1) is None:
+                self.curr_page = 0
+            else:
+                self.curr_page += 1
+
+            await self.show_page('Search Results for')
+
+        if emoji == HEART:
+            # trigger typing
+            await ctx.trigger_typing()
+            await ctx.invoke(self.cog.search_related,
+                             illust_id=self.illusts[self.curr_page].id)
+
+        if emoji == DOWNLOAD:
+            # invoke download command
+            await ctx.invoke(self.cog.download,
+                             illust_id=self.illusts[self.curr_page].id)
 
+    async def close(self) -> None:
+        self.cancel_upgrade()
+        self.pager.close()
+        await self.results.close()
 
 
+class GallerySession(MessageSession):
+    """Reaction controls of a create_gallery message"""
 
+    kind = 'gallery'
 
+    def __init__(self, cog: PixivCog, ctx, message, embed: discord.Embed,
+                 illust: IllustRecord, pages: LazyPageSource) -> None:
+        super().__init__(cog, ctx, message)
+        self.embed = embed
+        self.illust = illust
+        self.illusts = [illust]
+        self.pages = pages
+        self.curr_page = 0 # index starts at 0 -> display + 1
 
+    def upgrade_preview(self) -> None:
+        """Swaps in the full size page once the user stays on it"""
+        if self.pages.size == UPGRADE_SIZE:
+            return
+        self.upgrade_later(f"{self.illust.id}_p{self.curr_page}", functools.partial(
+            download_page, self.cog.pixiv, self.illust, self.curr_page, UPGRADE_SIZE,
+            Priority.PREFETCH))
 
+    async def show_page(self) -> None:
+        illust = self.illust
+        curr_page = self.curr_page
 
+        # swap the image and footer, title and caption stay the same
+        file = set_embed_image(self.embed, f"{illust.id}_p{curr_page}",
+                               await self.pages.get(curr_page))
+        self.embed.set_footer(text=f'Page Index {curr_page+1}/{len(self.pages)} id: {illust.id}')
 
+        await self.replace_message(self.embed, file)
+        self.upgrade_preview()
 
-# Starting Discord Bot
-client.run(TOKEN)
+    async def on_reaction(self, emoji: str, user_id: int) -> None:
+        pages_total = len(self.pages)
 
+        if emoji == LEFT_ARROW and pages_total > 1:
+            # calc new page
+            self.curr_page = self.curr_page - 1
+            if self.curr_page < 0:
+                self.curr_page = pages_total - 1
 
+            self.pages.prefetch(self.curr_page - 1)
+            await self.show_page()
 
+        if emoji == RIGHT_ARROW and pages_total > 1:
+            # calc new page
+            self.curr_page = (self.curr_page + 1) % pages_total
 
+            self.pages.prefetch(self.curr_page + 1)
+            await self.show_page()
 
+        if emoji == HEART:
+            await self.ctx.invoke(self.cog.search_related,
+                                  illust_id=self.illust.id)
 
+        if emoji == DOWNLOAD:
+            # invoke download command
+            await self.ctx.invoke(self.cog.download,
+                                  illust_id=self.illust.id)
 
+    async def close(self) -> None:
+        self.cancel_upgrade()
+        self.pages.close()
 
 
 
+class PixivBot(commands.Bot):
+    """
+    A bot running PixivCog. start() logs in to pixiv and connects to discord
+    concurrently instead of one after the other.
+    """
+
+    def __init__(self, settings: Settings, **options) -> None:
+        super().__init__(command_prefix=settings.command_prefix, **options)
+        self.settings = settings
+        self.remove_command('help')
+
+        self.pixiv_cog = PixivCog(self, settings)
+        self.add_cog(self.pixiv_cog)
 
+    async def start(self, *args, **kwargs) -> None:
+        await asyncio.gather(self.pixiv_cog.login(),
+                             super().start(*args, **kwargs))
 
+    async def close(self) -> None:
+        await self.pixiv_cog.close()
+        await super().close()
 
 
+class ShardedPixivBot(PixivBot, commands.AutoShardedBot):
+    """PixivBot running the shards settings.shard_ids of settings.shard_count"""
 
 
+def create_bot(settings: Union[str, Settings] = 'settings.cfg', **options) -> PixivBot:
+    """
+    Creates a bot configured by settings, or by the settings file at that
+    path. Nothing connects until the bot is started, e.g. with
+    bot.run(bot.settings.discord_token); options are passed on to
+    commands.Bot.
+    """
+    if not isinstance(settings, Settings):
+        settings = Settings(settings)
+    if settings.shard_count:
+        return ShardedPixivBot(settings, shard_count=settings.shard_count,
+                               shard_ids=settings.shard_ids, **options)
+    return PixivBot(settings, **options)
 
 
+def worker_shard_ids(settings: Settings, index: int) -> List[int]:
+    """The shards run by worker process index of settings.shard_processes"""
+    return list(range(index, settings.shard_count, settings.shard_processes))
 
 
+def run_worker(settings_path: str, index: int) -> None:
+    """
+    Runs the shards of worker process index. The worker gets its share of
+    the pixiv rate limits and cores, and of the metrics port range.
+    """
+    settings = Settings(settings_path)
+    processes = settings.shard_processes
 
+    settings.shard_ids = worker_shard_ids(settings, index)
+    settings.rate_share = 1 / processes
+    settings.image_workers = settings.image_workers or max(1, (os.cpu_count() or 1) // processes)
+    if settings.metrics_port:
+        settings.metrics_port += index
 
+    print(f'worker {index} running shards {settings.shard_ids}')
+    bot = create_bot(settings)
+    bot.run(settings.discord_token)
 
 
+def run_sharded(settings_path: str, settings: Settings) -> None:
+    """
+    Runs settings.shard_count shards in settings.shard_processes worker
+    processes and waits for them. Without a shared_store_path every worker
+    logs in to pixiv and caches on its own.
+    """
+    if not settings.shared_store_path:
+        print('shared_store_path is not set, workers will not share tokens or caches')
+
+    workers = [multiprocessing.Process(target=run_worker, args=(settings_path, index),
+                                       name=f'pixiv-bot-{index}')
+               for index in range(settings.shard_processes)]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        # the workers got the interrupt too and are shutting down
+        for worker in workers:
+            worker.join()
+
+
+def main(settings_path='settings.cfg') -> None:
+    settings = Settings(settings_path)
+    if settings.shard_count and settings.shard_processes > 1:
+        run_sharded(settings_path, settings)
+        return
 
+    bot = create_bot(settings)
+    bot.run(settings.discord_token)
 
 
+if __name__ == '__main__':
+    # Starting Discord Bot
+    main()
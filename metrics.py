@@ -0,0 +1,211 @@
+from aiohttp import web
+
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Tuple
+
+import bisect
+import contextlib
+import time
+
+# seconds, upper bounds of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Tuple[str, ...], values: LabelValues,
+                   extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metric:
+    """A metric family; every combination of label values is one series"""
+
+    kind = 'untyped'
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        return [f'# HELP {self.name} {self.help}',
+                f'# TYPE {self.name} {self.kind}',
+                *self.samples()]
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [f'{self.name}{_format_labels(self.labels, key)} {value}'
+                for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels) -> None:
+        self.values[self._key(labels)] = value
+
+
+class CallbackGauge(Metric):
+    """Gauge whose series are read from `function` whenever it is scraped"""
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...],
+                 function: Callable[[], Dict[LabelValues, float]]) -> None:
+        super().__init__(name, help, labels)
+        self.function = function
+
+    def samples(self) -> List[str]:
+        return [f'{self.name}{_format_labels(self.labels, key)} {value}'
+                for key, value in self.function().items()]
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = (),
+                 buckets=BUCKETS) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        # label values -> (count per bucket, +Inf last; sum)
+        self.values: Dict[LabelValues, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        series = self.values.get(key)
+        if series is None:
+            series = self.values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+        counts, total = series
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                cumulative += count
+                labels = _format_labels(self.labels, key, 'le="%s"' % bound)
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labels, key)} {total[0]}')
+            lines.append(f'{self.name}_count{_format_labels(self.labels, key)} {cumulative}')
+        return lines
+
+
+class Registry:
+    """The metrics exposed by one process"""
+
+    def __init__(self) -> None:
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """Returns every metric in the Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    'pixiv_bot_stage_seconds', 'Time spent per stage of handling a command',
+    ('stage',)))
+STAGE_IN_FLIGHT = REGISTRY.register(Gauge(
+    'pixiv_bot_stage_in_flight', 'Stages currently running', ('stage',)))
+STAGE_ERRORS = REGISTRY.register(Counter(
+    'pixiv_bot_stage_errors_total', 'Stages that raised, by exception type',
+    ('stage', 'error')))
+DOWNLOADED_BYTES = REGISTRY.register(Counter(
+    'pixiv_bot_downloaded_bytes_total', 'Image bytes downloaded from Pixiv'))
+UPLOADED_BYTES = REGISTRY.register(Counter(
+    'pixiv_bot_uploaded_bytes_total', 'Image bytes uploaded to Discord'))
+
+
+class Trace:
+    """Durations of the stages run on behalf of one traced command"""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.start = time.perf_counter()
+        self.spans: List[Tuple[str, float]] = []
+
+    def format(self) -> str:
+        total = time.perf_counter() - self.start
+        spans = ', '.join(f'{stage} {duration * 1000:.0f}ms'
+                          for stage, duration in self.spans)
+        return f'trace {self.name} {total * 1000:.0f}ms: {spans}'
+
+
+# trace of the command the current task runs on behalf of, if it is traced
+current_trace = ContextVar('current_trace', default=None) # type: ContextVar[Optional[Trace]]
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    """
+    Times the block as stage `name`: its duration goes into
+    STAGE_SECONDS and the current trace, if any, and it is counted in
+    STAGE_IN_FLIGHT while it runs.
+    """
+    STAGE_IN_FLIGHT.inc(stage=name)
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception as err:
+        STAGE_ERRORS.inc(stage=name, error=type(err).__name__)
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        STAGE_IN_FLIGHT.dec(stage=name)
+        STAGE_SECONDS.observe(duration, stage=name)
+
+        trace = current_trace.get()
+        if trace is not None:
+            trace.spans.append((name, duration))
+
+
+async def serve(registry: Registry, host: str, port: int) -> web.AppRunner:
+    """Serves registry at http://host:port/metrics until the runner is cleaned up"""
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(text=registry.render(),
+                            content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -1,21 +1,356 @@
 from pixivapi import Client
+from pixivapi.client import LOGIN_SECRET
 
-from pixivapi.errors import LoginError
-from pixivapi.models import Illustration
+from pixivapi.errors import AuthenticationRequired, BadApiResponse, LoginError, PixivError
+from pixivapi.models import Account, Illustration
 from pixivapi.enums  import ContentType, RankingMode, SearchTarget, Size, Sort, Visibility
 from pixivapi.common import HEADERS, format_bool, parse_qs, require_auth
 
 from PIL import Image
 from io import BytesIO
-
-from typing import Callable
+from datetime import datetime, timezone
+from json import JSONDecodeError
+from requests import RequestException
+
+from cache import ImageCache, ImageKey, MetadataCache
+from metrics import DOWNLOADED_BYTES, stage
+from scheduler import Priority, RateLimited, RequestScheduler
+from shared_store import LEASE_DURATION, SharedStore
+
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple, Union
+from urllib import parse
+import functools
+import hashlib
+import html
+import asyncio
+import aiohttp
 import json
+import re
+import time
 
 AUTH_URL = 'https://oauth.secure.pixiv.net/auth/token'
 BASE_URL = 'https://app-api.pixiv.net'
 FILTER = 'for_ios'
 
+# aiohttp connection pool settings
+CONNECTION_LIMIT = 32
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 60
+
+# largest image a single download may buffer, in bytes
+MAX_DOWNLOAD_BYTES = 64 * 1024 * 1024
+CHUNK_SIZE = 64 * 1024
+
+# concurrent image downloads, across the client and within one illustration
+MAX_DOWNLOADS = 16
+MAX_DOWNLOADS_PER_ILLUST = 4
+
+# requests per second and burst size allowed for each endpoint
+IMAGE_ENDPOINT = 'i.pximg.net'
+RATE_LIMITS = {
+    '/v2/search/autocomplete': (4.0, 8),
+    '/v1/search/popular-preview/illust': (1.0, 4),
+    '/v1/search/illust': (1.0, 4),
+    '/v1/illust/detail': (4.0, 8),
+    '/v2/illust/related': (1.0, 4),
+    IMAGE_ENDPOINT: (20.0, 40),
+}
+DEFAULT_RATE_LIMIT = (2.0, 4)
+
+# lifetime pixiv gives access tokens when the response does not say
+TOKEN_LIFETIME = 60 * 60
+# refresh access tokens this many seconds before they expire
+REFRESH_MARGIN = 5 * 60
+# wait before retrying a failed background refresh
+REFRESH_RETRY_DELAY = 30
+# SharedStore name of the pixiv tokens and of the lease to obtain them
+TOKEN_NAME = 'pixiv'
+# seconds between checks for a token another process is obtaining
+TOKEN_POLL_INTERVAL = 0.5
+
+# seconds responses of each endpoint stay in the metadata cache
+METADATA_TTL = {
+    'search_autocomplete': 24 * 60 * 60,
+    'search_popular_preview': 10 * 60,
+    'search_popular': 10 * 60,
+    'fetch_illustration': 60 * 60,
+}
+
+
+class FileTooLargeError(PixivError):
+    """
+    Raised when a download is larger than the allowed number of bytes.
+
+    :ivar str url: The URL of the file.
+    :ivar int max_bytes: The allowed number of bytes.
+    """
+
+    def __init__(self, url: str, max_bytes: int) -> None:
+        super().__init__(f'{url} is larger than {max_bytes} bytes')
+        self.url = url
+        self.max_bytes = max_bytes
+
+
+def _allocate_buffer(url: str, content_length: Optional[int],
+                     max_bytes: Optional[int]) -> BytesIO:
+    """
+    Checks the announced Content-Length against max_bytes and returns a
+    buffer preallocated to it, so streamed chunks are written in place.
+    """
+    if content_length is None:
+        return BytesIO()
+    if max_bytes is not None and content_length > max_bytes:
+        raise FileTooLargeError(url, max_bytes)
+
+    buffer = BytesIO()
+    if content_length:
+        buffer.seek(content_length - 1)
+        buffer.write(b'\0')
+        buffer.seek(0)
+    return buffer
+
+
+def _write_chunk(buffer: BytesIO, chunk: bytes, url: str,
+                 max_bytes: Optional[int]) -> None:
+    """Writes a streamed chunk, aborting once max_bytes is exceeded"""
+    if max_bytes is not None and buffer.tell() + len(chunk) > max_bytes:
+        raise FileTooLargeError(url, max_bytes)
+    buffer.write(chunk)
+
+
+def _finish_buffer(buffer: BytesIO) -> BytesIO:
+    """Drops unused preallocated space and rewinds the buffer"""
+    buffer.truncate()
+    buffer.seek(0)
+    return buffer
+
+
+class RateLimitError(BadApiResponse, RateLimited):
+    """Raised when Pixiv answers 429 Too Many Requests"""
+
+
+class ServerError(PixivError):
+    """Raised when Pixiv answers with a 5xx status"""
+
+
+class TokenExpiredError(BadApiResponse):
+    """Raised when Pixiv rejects the access token of a request"""
+
+
+# failures worth retrying after a backoff
+TRANSIENT_ERRORS = (aiohttp.ClientConnectionError, asyncio.TimeoutError, ServerError)
+
+
+async def _check_status(response: aiohttp.ClientResponse) -> None:
+    """Raises the error matching a failed response's status"""
+    if response.status == 429:
+        retry_after = response.headers.get('Retry-After')
+        try:
+            retry_after = float(retry_after) if retry_after else None
+        except ValueError:
+            retry_after = None
+        raise RateLimitError('Status code: 429', await response.text(),
+                             retry_after=retry_after)
+    if response.status // 100 == 5:
+        raise ServerError(f'Status code: {response.status}', await response.text())
+    if response.status in (400, 401):
+        # expired tokens are reported as a 400 invalid_grant by the app API
+        text = await response.text()
+        if response.status == 401 or 'invalid_grant' in text:
+            raise TokenExpiredError(f'Status code: {response.status}', text)
+        raise BadApiResponse(f'Status code: {response.status}', text)
+    if response.status // 100 == 4:
+        raise BadApiResponse(
+            f'Status code: {response.status}', await response.text()
+        )
+
+
+class PageDownloadError(PixivError):
+    """
+    Raised when some pages of an illustration failed to download.
+
+    :ivar list pages: The downloaded pages in page order, ``None`` where
+        the download failed.
+    :ivar dict errors: Maps the index of every failed page to its exception.
+    """
+
+    def __init__(self, pages: List[Optional[BytesIO]],
+                 errors: Dict[int, BaseException]) -> None:
+        super().__init__(f'Failed to download page(s) {sorted(errors)}')
+        self.pages = pages
+        self.errors = errors
+
+
+def require_auth_async(func):
+    """
+    Coroutine counterpart of pixivapi.common.require_auth. Raises
+    AuthenticationRequired if the client has no `access_token`.
+    """
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        if not self.access_token:
+            raise AuthenticationRequired
+        return await func(self, *args, **kwargs)
+
+    return wrapper
+
+
+# markup and links stripped from captions, line breaks are kept
+CAPTION_MARKUP = re.compile(r'(?P<br><br\s*/?>)|<[^<]+?>|https?://\S+',
+                            re.IGNORECASE)
+
+
+def _caption_replacement(match) -> str:
+    return '\n' if match.group('br') else ''
+
+
+def clean_caption(caption: str) -> str:
+    """
+    Removes HTML tags and links from an illustration caption in a single
+    pass, turns <br> into line breaks and decodes HTML entities.
+    """
+    return html.unescape(CAPTION_MARKUP.sub(_caption_replacement, caption)).strip()
+
+
+class IllustRecord:
+    """
+    The parts of an illustration the bot shows, built straight from the API
+    JSON. Much smaller than a pixivapi Illustration, which also parses and
+    keeps the user, tags, dates and a client reference.
+
+    :ivar int id: ID
+    :ivar str title: The title of the work.
+    :ivar str caption: The caption, cleaned with clean_caption.
+    :ivar dict urls: Maps every Size to a tuple of the image URL of each
+        page, ``None`` where Pixiv has no URL for the size.
+    :ivar int total_bookmarks: The number of times the illustration has
+        been bookmarked.
+    """
+
+    __slots__ = ('id', 'title', 'caption', 'urls', 'total_bookmarks')
+
+    def __init__(self, id: int, title: str, caption: str,
+                 urls: Dict[Size, Tuple[Optional[str], ...]],
+                 total_bookmarks: int) -> None:
+        self.id = id
+        self.title = title
+        self.caption = caption
+        self.urls = urls
+        self.total_bookmarks = total_bookmarks
+
+    def __repr__(self) -> str:
+        return f'IllustRecord(id={self.id!r}, title={self.title!r})'
+
+    @classmethod
+    def from_json(cls, illust: dict) -> 'IllustRecord':
+        """Builds the record from an illust object of an API response"""
+        if illust['meta_pages']:
+            pages = [page['image_urls'] for page in illust['meta_pages']]
+        else:
+            pages = [{**illust['image_urls'],
+                      Size.ORIGINAL.value:
+                          illust['meta_single_page'].get('original_image_url')}]
+
+        return cls(illust['id'], illust['title'], clean_caption(illust['caption']),
+                   {size: tuple(page.get(size.value) for page in pages)
+                    for size in Size},
+                   illust['total_bookmarks'])
+
+    @property
+    def page_count(self) -> int:
+        return len(self.urls[Size.LARGE])
+
+
+# anything the download and gallery helpers accept
+AnyIllust = Union[Illustration, IllustRecord]
+
+
+def illust_referer(illust: AnyIllust) -> str:
+    """Returns the Referer header i.pximg.net expects for the illustration"""
+    return (
+        'https://www.pixiv.net/member_illust.php?mode=medium'
+        f'&illust_id={illust.id}'
+    )
+
+
+def illust_page_urls(illust: AnyIllust, size=Size.LARGE) -> List[str]:
+    """Returns the image url of every page of the illustration at size"""
+    if isinstance(illust, IllustRecord):
+        return list(illust.urls[size])
+    if illust.meta_pages:
+        return [page[size] for page in illust.meta_pages]
+    return [illust.image_urls[size]]
+
+
 class ExtendedClient(Client):
+    """
+    pixivapi Client with extra endpoints.
+
+    :ivar float expires_at: time.monotonic() at which the access token
+        expires, ``None`` before the first authentication.
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.expires_at = None
+
+    def _make_auth_request(self, data):
+        """
+        Same handshake as Client._make_auth_request, additionally recording
+        when the access token expires.
+
+        :raises LoginError: If authentication fails.
+        """
+        client_time = (
+            datetime.utcnow()
+            .replace(microsecond=0)
+            .replace(tzinfo=timezone.utc)
+            .isoformat()
+        )
+
+        try:
+            r = self.session.post(
+                url=AUTH_URL,
+                data={
+                    'client_id': self.client_id,
+                    'client_secret': self.client_secret,
+                    'get_secure_url': 1,
+                    **data,
+                },
+                headers={
+                    'X-Client-Time': client_time,
+                    'X-Client-Hash': hashlib.md5(
+                        (client_time + LOGIN_SECRET).encode('utf-8')
+                    ).hexdigest(),
+                },
+            ).json()
+            self.account = Account(**r['response']['user'])
+            self.access_token = r['response']['access_token']
+            self.refresh_token = r['response']['refresh_token']
+            expires_in = r['response'].get('expires_in') or TOKEN_LIFETIME
+        except (RequestException, JSONDecodeError, KeyError) as e:
+            raise LoginError from e
+
+        self.expires_at = time.monotonic() + expires_in
+        self.session.headers.update(
+            {'Authorization': f'Bearer {self.access_token}'}
+        )
+
+    def use_tokens(self, access_token: str, refresh_token: str,
+                   expires_in: float) -> None:
+        """
+        Authenticates with tokens obtained elsewhere, e.g. by another
+        process, instead of logging in.
+
+        :param float expires_in: Seconds until the access token expires.
+        """
+        self.access_token = access_token
+        self.refresh_token = refresh_token
+        self.expires_at = time.monotonic() + expires_in
+        self.session.headers.update(
+            {'Authorization': f'Bearer {self.access_token}'}
+        )
+
     @require_auth
     def search_popular_preview(self, word: str,
                                search_target=SearchTarget.TAGS_EXACT):
@@ -100,24 +435,35 @@ class ExtendedClient(Client):
             'search_span_limit': response['search_span_limit'],
         }
 
-    def download_byte_stream(self, url: str, referer='https://pixiv.net') -> BytesIO:
+    def download_byte_stream(self, url: str, referer='https://pixiv.net',
+                             max_bytes=MAX_DOWNLOAD_BYTES) -> BytesIO:
         """
         This function returns the the BytesIO object of file at url.
         uses the client's access token if available.
+        The file is streamed in chunks and the download is aborted as soon
+        as it exceeds max_bytes.
         
-        :param str url:     The URL to the file.
-        :param str referer: The Referer header.
+        :param str url:       The URL to the file.
+        :param str referer:   The Referer header.
+        :param int max_bytes: The largest allowed file size, None for no limit.
 
         :return io.BytesIO 
 
         :rtype io.BytesIO   IO Buffered Bytes Stream
+
+        :raises FileTooLargeError: If the file is larger than max_bytes.
         """
 
-        response = self.session.get(
+        with self.session.get(
             url=url, headers={'Referer': referer}, stream=True
-        )
+        ) as response:
+            length = response.headers.get('Content-Length')
+            buffer = _allocate_buffer(url, int(length) if length else None,
+                                      max_bytes)
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                _write_chunk(buffer, chunk, url, max_bytes)
 
-        return BytesIO(response.content)
+        return _finish_buffer(buffer)
 
     def download_image(self, url: str, referer='https://pixiv.net') -> Image:
         """
@@ -231,18 +577,680 @@ class ExtendedClient(Client):
 
 
 
+class TokenManager:
+    """
+    Keeps the access token of an ExtendedClient valid.
+        - start() refreshes the token in the background `margin` seconds
+          before it expires
+        - refresh() is shared: callers arriving while a refresh is running
+          wait for it instead of starting their own
+        - wait() holds requests back while a refresh is running
+    Refresh tokens are handed to write_refresh whenever Pixiv issues a new
+    one, so a restart picks up the latest token.
+    """
+
+    def __init__(self, client: ExtendedClient,
+                 write_refresh: Optional[Callable[[str], None]] = None,
+                 margin=REFRESH_MARGIN,
+                 retry_delay=REFRESH_RETRY_DELAY) -> None:
+        self.client = client
+        self.write_refresh = write_refresh
+        self.margin = margin
+        self.retry_delay = retry_delay
+        self._refreshing = None
+        self._task = None
+
+    @property
+    def expires_in(self) -> float:
+        """Seconds until the access token expires, 0 if unknown or expired"""
+        if self.client.expires_at is None:
+            return 0.0
+        return max(0.0, self.client.expires_at - time.monotonic())
+
+    async def wait(self) -> None:
+        """Waits for a running refresh, if any"""
+        if self._refreshing is not None:
+            await asyncio.shield(self._refreshing)
+
+    async def refresh(self, stale_token: Optional[str] = None) -> None:
+        """
+        Obtains a new access token with the current refresh token.
+
+        :param str stale_token: The access token a request was rejected
+            with. If the client already moved on to another token, nothing
+            is refreshed.
+
+        :raises LoginError: If authentication fails.
+        """
+        if self._refreshing is None:
+            if stale_token is not None and stale_token != self.client.access_token:
+                return
+            self._refreshing = asyncio.ensure_future(self._refresh())
+            self._refreshing.add_done_callback(self._refreshed)
+        await asyncio.shield(self._refreshing)
+
+    async def _refresh(self) -> None:
+        old_refresh_token = self.client.refresh_token
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.client.authenticate,
+                                   old_refresh_token)
+
+        if self.write_refresh and self.client.refresh_token != old_refresh_token:
+            self.write_refresh(self.client.refresh_token)
+
+    def _refreshed(self, future: asyncio.Future) -> None:
+        self._refreshing = None
+        if not future.cancelled():
+            # retrieved by whoever awaited the refresh, or logged by _run
+            future.exception()
+
+    def start(self) -> None:
+        """Starts refreshing the token on the running event loop"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(max(0.0, self.expires_in - self.margin))
+            try:
+                await self.refresh()
+            except Exception as err:
+                print('Exception Raised while refreshing the access token')
+                print(err)
+                await asyncio.sleep(self.retry_delay)
+
+
+def adopt_shared_token(store: SharedStore, client: ExtendedClient,
+                       margin=REFRESH_MARGIN) -> bool:
+    """
+    Gives client the tokens in store if they are not the ones it already
+    has and are valid for more than margin seconds.
+
+    :return: Whether the tokens were adopted
+    """
+    shared = store.load_token(TOKEN_NAME)
+    if shared is None:
+        return False
+    access_token, refresh_token, expires_at = shared
+    expires_in = expires_at - time.time()
+    if access_token == client.access_token or expires_in <= margin:
+        return False
+    client.use_tokens(access_token, refresh_token, expires_in)
+    return True
+
+
+def shared_authenticate(store: SharedStore, client: ExtendedClient,
+                        authenticate: Callable[[], None],
+                        margin=REFRESH_MARGIN,
+                        poll_interval=TOKEN_POLL_INTERVAL) -> bool:
+    """
+    Authenticates client once for every process sharing store. Tokens
+    another process stored are adopted; otherwise the process holding the
+    token lease calls authenticate() and stores the tokens it obtained,
+    while the others wait for them. Blocks; run it in an executor from
+    async code.
+
+    :return: Whether this process called authenticate()
+
+    :raises LoginError: If authentication fails, or no tokens were stored
+        in twice the lease duration.
+    """
+    deadline = time.time() + 2 * LEASE_DURATION
+    while True:
+        if adopt_shared_token(store, client, margin):
+            return False
+
+        if store.acquire(TOKEN_NAME):
+            try:
+                # stored while we were acquiring the lease
+                if adopt_shared_token(store, client, margin):
+                    return False
+                authenticate()
+                store.save_token(TOKEN_NAME, client.access_token, client.refresh_token,
+                                 time.time() + (client.expires_at - time.monotonic()))
+                return True
+            finally:
+                store.release(TOKEN_NAME)
+
+        if time.time() > deadline:
+            raise LoginError('Timed out waiting for another process to log in')
+        time.sleep(poll_interval)
+
+
+class SharedTokenManager(TokenManager):
+    """
+    TokenManager of one of several processes using the same pixiv account.
+    Refreshes go through shared_authenticate, so only one process sends
+    them and the others adopt the token it stores in `store`.
+    """
+
+    def __init__(self, client: ExtendedClient, store: SharedStore,
+                 write_refresh: Optional[Callable[[str], None]] = None,
+                 margin=REFRESH_MARGIN,
+                 retry_delay=REFRESH_RETRY_DELAY) -> None:
+        super().__init__(client, write_refresh, margin, retry_delay)
+        self.store = store
+
+    async def _refresh(self) -> None:
+        old_refresh_token = self.client.refresh_token
+        loop = asyncio.get_event_loop()
+        refreshed = await loop.run_in_executor(None, functools.partial(
+            shared_authenticate, self.store, self.client,
+            lambda: self.client.authenticate(self.client.refresh_token),
+            margin=self.margin))
+
+        # only the process that refreshed writes the settings file
+        if (refreshed and self.write_refresh and
+                self.client.refresh_token != old_refresh_token):
+            self.write_refresh(self.client.refresh_token)
+
+
+class AsyncExtendedClient:
+    """
+    asyncio variant of ExtendedClient. API calls and image downloads go
+    through one pooled aiohttp session so they can be awaited from the
+    discord.py event loop. Authentication state is shared with the wrapped
+    ExtendedClient, so tokens obtained by PixivModule are reused as is.
+    API calls rejected for an expired token are retried once after the
+    token manager refreshed it. Processes sharing an account pass their
+    fraction of RATE_LIMITS as rate_share.
+    """
+
+    def __init__(self, client: ExtendedClient,
+                 connection_limit=CONNECTION_LIMIT,
+                 max_downloads=MAX_DOWNLOADS,
+                 max_downloads_per_illust=MAX_DOWNLOADS_PER_ILLUST,
+                 image_cache: Optional[ImageCache] = None,
+                 metadata_cache: Optional[MetadataCache] = None,
+                 max_download_bytes=MAX_DOWNLOAD_BYTES,
+                 scheduler: Optional[RequestScheduler] = None,
+                 tokens: Optional[TokenManager] = None,
+                 rate_share=1.0) -> None:
+        self.client = client
+        self.tokens = tokens or TokenManager(client)
+        self.scheduler = scheduler or RequestScheduler(
+            {endpoint: (rate * rate_share, burst)
+             for endpoint, (rate, burst) in RATE_LIMITS.items()},
+            (DEFAULT_RATE_LIMIT[0] * rate_share, DEFAULT_RATE_LIMIT[1]),
+            retry_on=TRANSIENT_ERRORS)
+        self.max_download_bytes = max_download_bytes
+        self.image_cache = image_cache
+        self.metadata_cache = metadata_cache
+        self.connection_limit = connection_limit
+        self.max_downloads = max_downloads
+        self.max_downloads_per_illust = max_downloads_per_illust
+        self._session = None
+        self._download_slots = None
+
+    @property
+    def access_token(self) -> str:
+        return self.client.access_token
+
+    @property
+    def refresh_token(self) -> str:
+        return self.client.refresh_token
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """
+        The shared aiohttp session, created on first use so that it binds
+        to the running event loop.
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.connection_limit,
+                                             ttl_dns_cache=300)
+            timeout = aiohttp.ClientTimeout(sock_connect=CONNECT_TIMEOUT,
+                                            sock_read=READ_TIMEOUT)
+            self._session = aiohttp.ClientSession(connector=connector,
+                                                  timeout=timeout,
+                                                  headers=HEADERS)
+        return self._session
+
+    @property
+    def download_slots(self) -> asyncio.Semaphore:
+        """Caps the number of image downloads in flight across the client"""
+        if self._download_slots is None:
+            self._download_slots = asyncio.Semaphore(self.max_downloads)
+        return self._download_slots
+
+    async def close(self) -> None:
+        """Closes the shared session and its connection pool"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+    def _headers(self, referer=None) -> dict:
+        headers = {}
+        if self.client.language:
+            headers['Accept-Language'] = self.client.language
+        if self.client.access_token:
+            headers['Authorization'] = f'Bearer {self.client.access_token}'
+        if referer:
+            headers['Referer'] = referer
+        return headers
+
+    async def authenticate(self, refresh_token: str) -> None:
+        """
+        Use a refresh token to obtain a new access token. The OAuth handshake
+        is delegated to the wrapped client in the default executor.
+
+        :param str refresh_token: The refresh token.
+
+        :raises LoginError: If authentication fails.
+        """
+        await self.tokens.wait()
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self.client.authenticate, refresh_token)
+
+    async def _cached(self, endpoint: str, key, fetch, use_cache: bool):
+        """Awaits fetch() through the metadata cache, if there is one"""
+        if self.metadata_cache is None or not use_cache:
+            return await fetch()
+        return await self.metadata_cache.get_or_fetch(endpoint, key, fetch)
+
+    async def _request_json(self, method: str, url: str, params=None, data=None,
+                            priority=Priority.SEARCH):
+        """
+        A wrapper for JSON requests. ``None`` params are dropped, matching
+        the behaviour of requests. Requests are paced per endpoint by the
+        scheduler and retried on 429s and transient failures. A request
+        rejected for an expired token is retried once with a new token.
+        """
+        params = {key: value
+                  for key, value in (params or {}).items()
+                  if value is not None}
+
+        async def request():
+            async with self.session.request(method, url, params=params, data=data,
+                                            headers=self._headers()) as response:
+                await _check_status(response)
+                try:
+                    return await response.json(content_type=None)
+                except ValueError as e:
+                    raise BadApiResponse from e
+
+        endpoint = parse.urlsplit(url).path
+        for attempt in range(2):
+            await self.tokens.wait()
+            token = self.client.access_token
+            try:
+                with stage(f'pixiv:{endpoint}'):
+                    return await self.scheduler.run(endpoint, request, priority)
+            except TokenExpiredError:
+                if attempt:
+                    raise
+                await self.tokens.refresh(stale_token=token)
+
+    @require_auth_async
+    async def search_popular_preview(self, word: str,
+                                     search_target=SearchTarget.TAGS_EXACT,
+                                     use_cache=True,
+                                     priority=Priority.SEARCH):
+        """
+        Search for popular previews at /v1/search/popular-preview/illust.
+        See ExtendedClient.search_popular_preview.
+
+        :param bool use_cache: Use the metadata cache for this call.
+        :param Priority priority: Scheduling priority of the request.
+
+        :raises aiohttp.ClientError: If the request fails.
+        :raises BadApiResponse: If the response is not valid JSON.
+        """
+        async def fetch():
+            response = await self._request_json(
+                method='get',
+                url=f"{BASE_URL}/v1/search/popular-preview/illust",
+                params={
+                    'word': word,
+                    'search_target': search_target.value,
+                    'sort': 'popular_desc',
+                    'filter': FILTER
+                },
+                priority=priority)
+
+            return {
+                'illustrations': [
+                    IllustRecord.from_json(illust)
+                    for illust in response['illusts']
+                ]
+            }
+
+        return await self._cached('search_popular_preview',
+                                  (word, search_target), fetch, use_cache)
+
+    @require_auth_async
+    async def search_popular(self, word: str,
+                             search_target=SearchTarget.TAGS_PARTIAL,
+                             duration=None,
+                             offset=None,
+                             use_cache=True,
+                             priority=Priority.SEARCH):
+        """
+        Search the illustrations by popularity. A maximum of 30 illustrations
+        are returned in one response. See ExtendedClient.search_popular.
+
+        :param bool use_cache: Use the metadata cache for the first page,
+            later pages are always requested.
+        :param Priority priority: Scheduling priority of the request.
+
+        :raises aiohttp.ClientError: If the request fails.
+        :raises BadApiResponse: If the response is not valid JSON.
+        """
+        async def fetch():
+            response = await self._request_json(
+                method='get',
+                url=f"{BASE_URL}/v1/search/illust",
+                params={
+                    'word': word,
+                    'search_target': search_target.value,
+                    'sort': 'popular_desc',
+                    'duration': duration.value if duration else None,
+                    'offset': offset,
+                    'filter': FILTER,
+                },
+                priority=priority)
+
+            return {
+                'illustrations': [
+                    IllustRecord.from_json(illust)
+                    for illust in response['illusts']
+                ],
+                'next': parse_qs(response['next_url'], param='offset'),
+                'search_span_limit': response['search_span_limit'],
+            }
+
+        return await self._cached('search_popular', (word, search_target, duration),
+                                  fetch, use_cache and offset is None)
+
+    async def search_popular_pages(self, word: str,
+                                   search_target=SearchTarget.TAGS_PARTIAL,
+                                   duration=None,
+                                   offset=None,
+                                   use_cache=True,
+                                   priority=Priority.SEARCH
+                                   ) -> AsyncIterator[List[IllustRecord]]:
+        """
+        Async generator over the result pages of search_popular. The next
+        page is only requested once the previous one was consumed, and
+        the generator ends when Pixiv reports no further page.
+
+        :raises aiohttp.ClientError: If a request fails.
+        :raises BadApiResponse: If a response is not valid JSON.
+        """
+        while True:
+            response = await self.search_popular(word,
+                                                 search_target=search_target,
+                                                 duration=duration,
+                                                 offset=offset,
+                                                 use_cache=use_cache,
+                                                 priority=priority)
+            yield response['illustrations']
+
+            offset = response['next']
+            if offset is None or not response['illustrations']:
+                return
+
+    @require_auth_async
+    async def fetch_illustration(self, illustration_id: int,
+                                 use_cache=True,
+                                 priority=Priority.NAVIGATION) -> IllustRecord:
+        """
+        Fetch the details of a single illustration.
+
+        :param int illustration_id: The ID of the illustration.
+        :param bool use_cache: Use the metadata cache for this call.
+        :param Priority priority: Scheduling priority of the request.
+
+        :rtype: IllustRecord
+
+        :raises aiohttp.ClientError: If the request fails.
+        :raises BadApiResponse: If the response is not valid JSON.
+        """
+        async def fetch():
+            response = await self._request_json(
+                method='get',
+                url=f'{BASE_URL}/v1/illust/detail',
+                params={'illust_id': illustration_id},
+                priority=priority,
+            )
+
+            return IllustRecord.from_json(response['illust'])
+
+        return await self._cached('fetch_illustration', illustration_id,
+                                  fetch, use_cache)
+
+    @require_auth_async
+    async def fetch_illustration_related(self, illustration_id: int,
+                                         offset=None,
+                                         priority=Priority.SEARCH):
+        """
+        Fetch illustrations related to a specified illustration. A maximum
+        of 30 illustrations are returned in one response.
+
+        :param int illustration_id: The ID of the illustration.
+        :param int offset: Illustrations to offset by.
+        :param Priority priority: Scheduling priority of the request.
+
+        :return: A dictionary containing the related illustrations and the
+            offset for the next page (``None`` if there is no next page).
+        .. code-block:: python
+           {
+               'illustrations': [IllustRecord, ...],
+               'next': 30,
+           }
+        :rtype: dict
+
+        :raises aiohttp.ClientError: If the request fails.
+        :raises BadApiResponse: If the response is not valid JSON.
+        """
+        response = await self._request_json(
+            method='get',
+            url=f'{BASE_URL}/v2/illust/related',
+            params={
+                'illust_id': illustration_id,
+                'offset': offset,
+            },
+            priority=priority)
+
+        return {
+            'illustrations': [
+                IllustRecord.from_json(illust)
+                for illust in response['illusts']
+            ],
+            'next': parse_qs(response['next_url'], param='offset'),
+        }
+
+    async def search_autocomplete(self, word: str, ver='v2', use_cache=True,
+                                  priority=Priority.SEARCH):
+        """
+        Get autocompleted tags for the given search query word.
+        See ExtendedClient.search_autocomplete.
+
+        :param bool use_cache: Use the metadata cache for this call.
+        :param Priority priority: Scheduling priority of the request.
+
+        :rtype list
+        """
+        async def fetch():
+            response = await self._request_json(
+                method='get',
+                url=f"{BASE_URL}/{ver}/search/autocomplete",
+                params={
+                    'word': word
+                    },
+                priority=priority
+                )
+
+            return response['tags']
+
+        return await self._cached('search_autocomplete', (word, ver),
+                                  fetch, use_cache)
+
+    async def download_byte_stream(self, url: str,
+                                   referer='https://pixiv.net',
+                                   cache_key: Optional[ImageKey] = None,
+                                   max_bytes: Optional[int] = None,
+                                   priority=Priority.NAVIGATION) -> BytesIO:
+        """
+        This function returns the BytesIO object of file at url.
+        uses the client's access token if available.
+        The file is streamed in chunks and the download is aborted as soon
+        as it exceeds max_bytes.
+
+        :param str url:     The URL to the file.
+        :param str referer: The Referer header.
+        :param tuple cache_key: (illust id, page, Size) of the file, looked
+            up in and stored to the image cache when given.
+        :param int max_bytes: The largest allowed file size, defaults to
+            `max_download_bytes`.
+        :param Priority priority: Scheduling priority of the download.
+
+        :rtype io.BytesIO   IO Buffered Bytes Stream
+
+        :raises aiohttp.ClientError: If the request fails.
+        :raises FileTooLargeError: If the file is larger than max_bytes.
+        """
+        loop = asyncio.get_event_loop()
+        use_cache = self.image_cache is not None and cache_key is not None
+        if max_bytes is None:
+            max_bytes = self.max_download_bytes
+
+        if use_cache:
+            data = await loop.run_in_executor(None, self.image_cache.get, cache_key)
+            if data is not None:
+                if max_bytes is not None and len(data) > max_bytes:
+                    raise FileTooLargeError(url, max_bytes)
+                return BytesIO(data)
+
+        async def download():
+            async with self.download_slots:
+                async with self.session.get(url, headers=self._headers(referer)) as response:
+                    await _check_status(response)
+                    buffer = _allocate_buffer(url, response.content_length, max_bytes)
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        _write_chunk(buffer, chunk, url, max_bytes)
+            return buffer
+
+        with stage('pixiv:download'):
+            buffer = _finish_buffer(
+                await self.scheduler.run(IMAGE_ENDPOINT, download, priority))
+        DOWNLOADED_BYTES.inc(buffer.getbuffer().nbytes)
+
+        if use_cache:
+            await loop.run_in_executor(None, self.image_cache.put,
+                                       cache_key, buffer.getvalue())
+
+        return buffer
+
+    async def get_illust_byte_streams(self, illust: AnyIllust,
+                                      size=Size.LARGE,
+                                      return_exceptions=False,
+                                      max_bytes: Optional[int] = None,
+                                      fallback_size: Optional[Size] = None,
+                                      priority=Priority.NAVIGATION
+                                      ) -> List[BytesIO]:
+        """
+        Load the illustration to an array of BytesIO. If illustration has
+        only a single page, the array of BytesIO with be length of one.
+        Pages are downloaded concurrently, at most `max_downloads_per_illust`
+        at a time, and returned in page order.
+
+        :param IllustRecord illust: The illustration to load, a pixivapi
+            Illustration works as well.
+        :param Size size: The size of the image to download.
+        :param bool return_exceptions: Put the exception of a failed page in
+            its slot instead of raising PageDownloadError.
+        :param int max_bytes: The largest allowed page size, defaults to
+            `max_download_bytes`.
+        :param Size fallback_size: Size to download pages larger than
+            max_bytes in instead.
+        :param Priority priority: Scheduling priority of the downloads.
+
+        :rtype List[io.BytesIO]: Array of Images
+
+        :raises PageDownloadError: If any page fails to download.
+        """
+        referer = illust_referer(illust)
+        illust_slots = asyncio.Semaphore(self.max_downloads_per_illust)
+
+        async def download_page(index: int, url: str) -> BytesIO:
+            async with illust_slots:
+                try:
+                    return await self.download_byte_stream(
+                        url, referer=referer, cache_key=(illust.id, index, size),
+                        max_bytes=max_bytes, priority=priority)
+                except FileTooLargeError:
+                    if fallback_size is None:
+                        raise
+                    fallback_url = illust_page_urls(illust, fallback_size)[index]
+                    return await self.download_byte_stream(
+                        fallback_url, referer=referer,
+                        cache_key=(illust.id, index, fallback_size),
+                        max_bytes=max_bytes, priority=priority)
+
+        results = await asyncio.gather(
+            *[download_page(index, url)
+              for index, url in enumerate(illust_page_urls(illust, size))],
+            return_exceptions=True
+        )
+
+        if return_exceptions:
+            return results
+
+        errors = {index: result
+                  for index, result in enumerate(results)
+                  if isinstance(result, BaseException)}
+        if errors:
+            pages = [None if index in errors else result
+                     for index, result in enumerate(results)]
+            raise PageDownloadError(pages, errors)
+
+        return results
+
+    async def get_illust_images(self, illust: AnyIllust,
+                                size=Size.LARGE) -> List[Image.Image]:
+        """
+        Load the illustration to an array of Images, downloading the pages
+        concurrently. See get_illust_byte_streams.
+
+        :rtype List[Pillow.Image]: Array of Images
+
+        :raises PageDownloadError: If any page fails to download.
+        """
+        return [Image.open(stream)
+                for stream in await self.get_illust_byte_streams(illust, size)]
+
+
 class PixivModule:
     def __init__(self, username: str, password: str,
-                 write_refresh: Callable[[str], None], refresh_token=None) -> None:
+                 write_refresh: Callable[[str], None], refresh_token=None,
+                 token_store: Optional[SharedStore] = None) -> None:
         """
         Create pixiv-api client with the correct authentication
             - attempts refresh_token first
             - on failure, use username and password to authenticate
                 - on failure, raise Authentication Error 
+            - with a token_store, tokens another process stored there are
+              used instead, and only one process logs in, see
+              shared_authenticate
         """
 
         self.client = ExtendedClient()
-        
+
+        if token_store is None:
+            self._login(username, password, write_refresh, refresh_token)
+            self.tokens = TokenManager(self.client, write_refresh)
+        else:
+            shared_authenticate(token_store, self.client, functools.partial(
+                self._login, username, password, write_refresh, refresh_token))
+            self.tokens = SharedTokenManager(self.client, token_store, write_refresh)
+
+    def _login(self, username: str, password: str,
+               write_refresh: Callable[[str], None], refresh_token=None) -> None:
         try:
             print("Attempting login with refresh token: ", end="")
             self.client.authenticate(refresh_token)
@@ -260,6 +1268,14 @@ class PixivModule:
         """Returns the pixiv-api client"""
         return self.client
 
+    def get_async_client(self, **kwargs) -> AsyncExtendedClient:
+        """
+        Returns an asyncio client sharing this client's authentication and
+        token manager. kwargs are passed on to AsyncExtendedClient.
+        """
+        kwargs.setdefault('tokens', self.tokens)
+        return AsyncExtendedClient(self.client, **kwargs)
+
 
 
     
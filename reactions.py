@@ -0,0 +1,159 @@
+from typing import Dict, Hashable, List, Set
+
+import asyncio
+import math
+import time
+
+
+class ReactionSession:
+    """
+    A message that responds to reactions, e.g. a gallery. Sessions are
+    registered with a ReactionDispatcher under the id of their message.
+    """
+
+    def __init__(self, message, timeout: float) -> None:
+        self.message = message
+        self.timeout = timeout
+        self.lock = asyncio.Lock()
+
+    async def on_reaction(self, emoji: str, user_id: int) -> None:
+        """Called for every reaction a user adds to the message"""
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        """Called once the session timed out or failed"""
+
+
+class TimerWheel:
+    """
+    Hashed timer wheel. Keys are placed into one of `slots` buckets of
+    `tick` seconds each; advance() is called once per tick and returns the
+    keys whose deadline passed. Rescheduling or cancelling a key is O(1),
+    stale bucket entries are skipped lazily.
+    """
+
+    def __init__(self, tick: float, slots: int) -> None:
+        self.tick = tick
+        self.position = 0
+        self._slots: List[Set[Hashable]] = [set() for _ in range(slots)]
+        self._deadlines: Dict[Hashable, float] = {}
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._deadlines
+
+    def _place(self, key: Hashable, delay: float) -> None:
+        ticks = min(max(1, math.ceil(delay / self.tick)), len(self._slots) - 1)
+        self._slots[(self.position + ticks) % len(self._slots)].add(key)
+
+    def schedule(self, key: Hashable, delay: float) -> None:
+        """(Re)schedules key to expire in delay seconds"""
+        self._deadlines[key] = time.monotonic() + delay
+        self._place(key, delay)
+
+    def cancel(self, key: Hashable) -> None:
+        self._deadlines.pop(key, None)
+
+    def advance(self) -> List[Hashable]:
+        """Moves the wheel one tick forward and returns the expired keys"""
+        self.position = (self.position + 1) % len(self._slots)
+        bucket = self._slots[self.position]
+        self._slots[self.position] = set()
+
+        now = time.monotonic()
+        expired = []
+        for key in bucket:
+            deadline = self._deadlines.get(key)
+            if deadline is None:
+                continue
+            if deadline <= now:
+                del self._deadlines[key]
+                expired.append(key)
+            else:
+                # rescheduled since, or further away than one turn
+                self._place(key, deadline - now)
+
+        return expired
+
+
+class ReactionDispatcher:
+    """
+    Routes reaction events to the session of their message in O(1) and
+    expires idle sessions with one shared timer wheel, instead of every
+    session running its own client.wait_for loop.
+
+    Reactions of one session are handled one at a time, in order. A
+    session's timeout restarts with every reaction it handles.
+    """
+
+    def __init__(self, tick=1.0, slots=64) -> None:
+        self.sessions: Dict[int, ReactionSession] = {}
+        self.timers = TimerWheel(tick, slots)
+        self._task = None
+
+    def __len__(self) -> int:
+        return len(self.sessions)
+
+    def register(self, session: ReactionSession) -> None:
+        """Starts routing reactions on session.message to session"""
+        self.sessions[session.message.id] = session
+        self.timers.schedule(session.message.id, session.timeout)
+
+    def rekey(self, old_id: int, session: ReactionSession) -> None:
+        """Moves a session whose message was replaced to its new message"""
+        self.sessions.pop(old_id, None)
+        self.timers.cancel(old_id)
+        self.register(session)
+
+    async def end(self, session: ReactionSession) -> None:
+        """Unregisters and closes the session"""
+        if self.sessions.get(session.message.id) is session:
+            del self.sessions[session.message.id]
+            self.timers.cancel(session.message.id)
+        await session.close()
+
+    async def dispatch(self, message_id: int, emoji: str, user_id: int) -> None:
+        """Handles a reaction added to message_id, if a session owns it"""
+        session = self.sessions.get(message_id)
+        if session is None:
+            return
+
+        async with session.lock:
+            # the session may have ended while waiting for the lock
+            if self.sessions.get(session.message.id) is not session:
+                return
+            try:
+                await session.on_reaction(emoji, user_id)
+            except Exception as err:
+                print("Something else went wrong")
+                print(err)
+                await self.end(session)
+                return
+
+            self.timers.schedule(session.message.id, session.timeout)
+
+    def start(self) -> None:
+        """Starts expiring sessions on the running event loop"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.timers.tick)
+            for message_id in self.timers.advance():
+                session = self.sessions.get(message_id)
+                if session is not None:
+                    asyncio.ensure_future(self._expire(session))
+
+    async def _expire(self, session: ReactionSession) -> None:
+        async with session.lock:
+            # a reaction handled while waiting for the lock restarts the timeout
+            if session.message.id not in self.timers:
+                await self.end(session)
@@ -0,0 +1,150 @@
+from enum import IntEnum
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import asyncio
+import heapq
+import itertools
+import random
+import time
+
+
+class Priority(IntEnum):
+    """Order in which queued requests are sent, lowest first"""
+    NAVIGATION = 0 # a user is waiting on a page flip or gallery
+    SEARCH = 1     # commands: searches, tag lookups, related works
+    PREFETCH = 2   # background work nobody is waiting on yet
+
+
+class RateLimited(Exception):
+    """
+    Raised by a request that was rejected for exceeding a rate limit.
+
+    :ivar float retry_after: Seconds to wait before retrying, if known.
+    """
+
+    def __init__(self, *args, retry_after: Optional[float] = None) -> None:
+        super().__init__(*args)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Allows `rate` requests per second with bursts of up to `capacity`"""
+
+    def __init__(self, rate: float, capacity: int) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def delay(self) -> float:
+        """Returns the seconds until a token is available, 0 if one is"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self) -> None:
+        self.tokens -= 1
+
+
+class RequestScheduler:
+    """
+    Paces outbound requests with one token bucket per endpoint.
+        - requests waiting for the same endpoint are released in Priority
+          order, first come first served within a priority
+        - a RateLimited error pauses the whole endpoint for its retry_after
+          (or a backoff) and the request is retried
+        - errors in `retry_on` are retried after a jittered exponential
+          backoff, at most `max_retries` times
+    """
+
+    def __init__(self, rates: Dict[str, Tuple[float, int]],
+                 default_rate: Tuple[float, int],
+                 retry_on: Tuple[type, ...] = (),
+                 max_retries=3, backoff_base=0.5, backoff_max=30.0) -> None:
+        self.rates = dict(rates)
+        self.default_rate = default_rate
+        self.retry_on = retry_on
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._waiters: Dict[str, List[Tuple[int, int, asyncio.Future]]] = {}
+        self._paused_until: Dict[str, float] = {}
+        self._pumps: Dict[str, asyncio.Future] = {}
+        self._counter = itertools.count()
+
+    def _bucket(self, endpoint: str) -> TokenBucket:
+        bucket = self._buckets.get(endpoint)
+        if bucket is None:
+            rate, capacity = self.rates.get(endpoint, self.default_rate)
+            bucket = self._buckets[endpoint] = TokenBucket(rate, capacity)
+        return bucket
+
+    def backoff(self, attempt: int) -> float:
+        """Full jitter exponential backoff for the given retry attempt"""
+        return random.uniform(0, min(self.backoff_max,
+                                     self.backoff_base * 2 ** attempt))
+
+    def pause(self, endpoint: str, seconds: float) -> None:
+        """Holds back every request to endpoint for the next seconds"""
+        self._paused_until[endpoint] = max(self._paused_until.get(endpoint, 0.0),
+                                           time.monotonic() + seconds)
+
+    async def acquire(self, endpoint: str, priority=Priority.SEARCH) -> None:
+        """Waits until a request to endpoint may be sent"""
+        future = asyncio.get_event_loop().create_future()
+        waiters = self._waiters.setdefault(endpoint, [])
+        heapq.heappush(waiters, (priority, next(self._counter), future))
+
+        if endpoint not in self._pumps:
+            self._pumps[endpoint] = asyncio.ensure_future(self._pump(endpoint))
+
+        await future
+
+    async def _pump(self, endpoint: str) -> None:
+        """Releases the waiters of endpoint as tokens become available"""
+        bucket = self._bucket(endpoint)
+        waiters = self._waiters[endpoint]
+        try:
+            while waiters:
+                # skip requests that gave up waiting
+                if waiters[0][2].done():
+                    heapq.heappop(waiters)
+                    continue
+
+                delay = max(bucket.delay(),
+                            self._paused_until.get(endpoint, 0.0) - time.monotonic())
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                    continue
+
+                bucket.consume()
+                _, _, future = heapq.heappop(waiters)
+                future.set_result(None)
+        finally:
+            del self._pumps[endpoint]
+
+    async def run(self, endpoint: str, call: Callable[[], Awaitable[Any]],
+                  priority=Priority.SEARCH) -> Any:
+        """
+        Awaits call() once endpoint has capacity, retrying rate limited and
+        transient failures.
+        """
+        for attempt in range(self.max_retries + 1):
+            await self.acquire(endpoint, priority)
+            try:
+                return await call()
+            except RateLimited as err:
+                if attempt == self.max_retries:
+                    raise
+                retry_after = err.retry_after
+                if retry_after is None:
+                    retry_after = self.backoff(attempt)
+                self.pause(endpoint, retry_after)
+            except self.retry_on:
+                if attempt == self.max_retries:
+                    raise
+                await asyncio.sleep(self.backoff(attempt))
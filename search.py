@@ -0,0 +1,85 @@
+from pixiv_module import IllustRecord
+
+from typing import AsyncIterator, List, Optional, Set
+
+import asyncio
+
+
+async def _no_pages() -> AsyncIterator[List[IllustRecord]]:
+    return
+    yield
+
+
+class DeepSearch:
+    """
+    Search results that are fetched a page at a time, only when a caller
+    asks for an index past the results loaded so far.
+        - illustrations already seen on an earlier page are dropped
+        - with rank_pages, that many pages are fetched together and the
+          merged batch is ordered by total_bookmarks. Ranking is per batch,
+          earlier results never move. The first batch is a single page, so
+          the first result is shown after one request.
+    """
+
+    def __init__(self, pages: AsyncIterator[List[IllustRecord]],
+                 rank_pages=0) -> None:
+        self.illusts: List[IllustRecord] = []
+        self.exhausted = False
+        self.rank_pages = rank_pages
+
+        self._pages = pages
+        self._seen: Set[int] = set()
+        self._lock = asyncio.Lock()
+
+    @classmethod
+    def finished(cls, illusts: List[IllustRecord]) -> 'DeepSearch':
+        """Results loaded earlier, e.g. by a revived session; nothing more is fetched"""
+        search = cls(_no_pages())
+        search.illusts = list(illusts)
+        search.exhausted = True
+        search._seen = {illust.id for illust in illusts}
+        return search
+
+    def __len__(self) -> int:
+        return len(self.illusts)
+
+    async def load_more(self) -> int:
+        """
+        Fetches the next batch of results and returns how many new
+        illustrations it added, 0 once the search is exhausted.
+
+        :raises aiohttp.ClientError: If a request fails.
+        """
+        async with self._lock:
+            batch = []
+            pages = max(1, self.rank_pages) if self.illusts else 1
+            while not batch and not self.exhausted:
+                for _ in range(pages):
+                    try:
+                        page = await self._pages.__anext__()
+                    except StopAsyncIteration:
+                        self.exhausted = True
+                        break
+
+                    for illust in page:
+                        if illust.id not in self._seen:
+                            self._seen.add(illust.id)
+                            batch.append(illust)
+
+            if self.rank_pages:
+                batch.sort(key=lambda illust: illust.total_bookmarks,
+                           reverse=True)
+            self.illusts.extend(batch)
+            return len(batch)
+
+    async def get(self, index: int) -> Optional[IllustRecord]:
+        """Returns the result at index, loading pages up to it; None past the end"""
+        while index >= len(self.illusts) and not self.exhausted:
+            await self.load_more()
+        if index < len(self.illusts):
+            return self.illusts[index]
+        return None
+
+    async def close(self) -> None:
+        """Stops the underlying page generator"""
+        await self._pages.aclose()
@@ -0,0 +1,148 @@
+from pixiv_module import IllustRecord
+
+from array import array
+from typing import Iterable, List, Optional, Tuple
+
+import pickle
+import sqlite3
+import threading
+import time
+
+# saved sessions can be revived this long after their last page change, in seconds
+MAX_AGE = 24 * 60 * 60
+# ids per query, below SQLite's limit on bound parameters
+QUERY_IDS = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    message_id INTEGER PRIMARY KEY,
+    channel_id INTEGER NOT NULL,
+    kind       TEXT NOT NULL,
+    illust_ids BLOB NOT NULL,
+    page       INTEGER NOT NULL,
+    expires    REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_expires ON sessions (expires);
+CREATE TABLE IF NOT EXISTS illusts (
+    id      INTEGER PRIMARY KEY,
+    record  BLOB NOT NULL,
+    expires REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS illusts_expires ON illusts (expires);
+"""
+
+
+class SavedSession:
+    """
+    The state a reaction session needs to be revived: its message, what
+    it shows and the page it is on. `expires` is a time.time() timestamp.
+    """
+
+    __slots__ = ('message_id', 'channel_id', 'kind', 'illust_ids', 'page', 'expires')
+
+    def __init__(self, message_id: int, channel_id: int, kind: str,
+                 illust_ids: List[int], page: int, expires: float) -> None:
+        self.message_id = message_id
+        self.channel_id = channel_id
+        self.kind = kind
+        self.illust_ids = illust_ids
+        self.page = page
+        self.expires = expires
+
+    def __repr__(self) -> str:
+        return (f'<SavedSession {self.kind} message={self.message_id} '
+                f'page={self.page + 1}/{len(self.illust_ids)}>')
+
+
+class SessionStore:
+    """
+    SQLite store of reaction sessions, so galleries outlive the in-memory
+    session and restarts of the bot.
+        - a session is a row of its message id, channel id, kind, page and
+          illustration ids, packed as 64 bit integers
+        - illustration records are kept once in their own table, however
+          many sessions show them, so a revived session needs no API calls
+        - sessions and records expire max_age seconds after the last save
+          that used them and are deleted by the next save
+    Methods do blocking file I/O; async callers should run them in an
+    executor.
+    """
+
+    def __init__(self, path: str, max_age=MAX_AGE) -> None:
+        self.path = path
+        self.max_age = max_age
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(SCHEMA)
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+    def save(self, session: SavedSession, new_illusts: Iterable[IllustRecord] = (),
+             previous_id: Optional[int] = None) -> None:
+        """
+        Stores session with an expiry max_age from now.
+
+        :param new_illusts: Records of the session's illustrations that
+            were not saved with it before.
+        :param int previous_id: The id the session was saved under before
+            its message was replaced, that row is dropped.
+        """
+        now = time.time()
+        session.expires = now + self.max_age
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM sessions WHERE expires <= ?', (now,))
+            self._db.execute('DELETE FROM illusts WHERE expires <= ?', (now,))
+            if previous_id is not None:
+                self._db.execute('DELETE FROM sessions WHERE message_id = ?',
+                                 (previous_id,))
+
+            self._db.execute(
+                'INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?, ?, ?)',
+                (session.message_id, session.channel_id, session.kind,
+                 array('q', session.illust_ids).tobytes(), session.page,
+                 session.expires))
+            self._db.executemany(
+                'INSERT OR REPLACE INTO illusts VALUES (?, ?, ?)',
+                [(illust.id, pickle.dumps(illust, pickle.HIGHEST_PROTOCOL),
+                  session.expires) for illust in new_illusts])
+            # records saved earlier live as long as the sessions showing them
+            self._db.executemany(
+                'UPDATE illusts SET expires = ? WHERE id = ? AND expires < ?',
+                [(session.expires, illust_id, session.expires)
+                 for illust_id in session.illust_ids])
+
+    def load(self, message_id: int) -> Optional[Tuple[SavedSession, List[IllustRecord]]]:
+        """
+        :return: The session saved for message_id and the records of its
+            illustrations in order, None if there is none or it expired
+        """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT channel_id, kind, illust_ids, page, expires FROM sessions '
+                'WHERE message_id = ? AND expires > ?',
+                (message_id, time.time())).fetchone()
+            if row is None:
+                return None
+
+            channel_id, kind, packed_ids, page, expires = row
+            illust_ids = array('q', packed_ids).tolist()
+            records = {}
+            for start in range(0, len(illust_ids), QUERY_IDS):
+                chunk = illust_ids[start:start + QUERY_IDS]
+                records.update(self._db.execute(
+                    'SELECT id, record FROM illusts '
+                    f'WHERE id IN ({",".join("?" * len(chunk))})', chunk))
+
+        # every record is saved with or before its first session
+        if len(records) != len(set(illust_ids)):
+            return None
+        return (SavedSession(message_id, channel_id, kind, illust_ids, page, expires),
+                [pickle.loads(records[illust_id]) for illust_id in illust_ids])
+
+    def delete(self, message_id: int) -> None:
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM sessions WHERE message_id = ?', (message_id,))
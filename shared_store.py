@@ -0,0 +1,217 @@
+from typing import Any, List, Optional, Tuple
+
+import contextlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+# seconds a process may hold a lease before others may take it over
+LEASE_DURATION = 60.0
+# seconds an image's last use may lag behind, so cache hits rarely write
+USE_RESOLUTION = 60.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tokens (
+    name          TEXT PRIMARY KEY,
+    access_token  TEXT NOT NULL,
+    refresh_token TEXT NOT NULL,
+    expires_at    REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS leases (
+    name  TEXT PRIMARY KEY,
+    owner TEXT NOT NULL,
+    until REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS metadata (
+    endpoint TEXT NOT NULL,
+    key      TEXT NOT NULL,
+    expires  REAL NOT NULL,
+    value    BLOB NOT NULL,
+    PRIMARY KEY (endpoint, key)
+);
+CREATE INDEX IF NOT EXISTS metadata_expires ON metadata (expires);
+CREATE TABLE IF NOT EXISTS images (
+    filename TEXT PRIMARY KEY,
+    size     INTEGER NOT NULL,
+    used     REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS images_used ON images (used);
+"""
+
+# (access token, refresh token, expiry as a time.time() timestamp)
+SharedToken = Tuple[str, str, float]
+
+
+class SharedStore:
+    """
+    SQLite database shared by the worker processes of one deployment.
+        - the pixiv tokens, so only one process logs in or refreshes and
+          the others adopt its tokens
+        - leases, which elect the process doing such work
+        - API responses, as a second tier behind every process's
+          MetadataCache
+        - the index of a shared ImageCache directory
+    The database is in WAL mode, so readers in one process do not block a
+    writer in another. Times are time.time() timestamps since they are
+    compared across processes. Methods do blocking file I/O; async callers
+    should run them in an executor.
+    """
+
+    def __init__(self, path: str, timeout=30.0) -> None:
+        self.path = path
+        # identifies this process in leases
+        self.owner = f'{os.getpid()}@{id(self):x}'
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=timeout, check_same_thread=False,
+                                   isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(SCHEMA)
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """
+        Runs the block in a write transaction, taking the write lock up
+        front so concurrent writers queue instead of failing. Needs _lock
+        """
+        self._db.execute('BEGIN IMMEDIATE')
+        try:
+            yield self._db
+        except BaseException:
+            self._db.execute('ROLLBACK')
+            raise
+        self._db.execute('COMMIT')
+
+    def _write(self, sql: str, parameters=()) -> sqlite3.Cursor:
+        """Runs one write statement in its own transaction. Needs _lock"""
+        with self._transaction() as db:
+            return db.execute(sql, parameters)
+
+    # tokens
+
+    def load_token(self, name: str) -> Optional[SharedToken]:
+        """Returns the tokens stored under name, or None"""
+        with self._lock:
+            return self._db.execute(
+                'SELECT access_token, refresh_token, expires_at FROM tokens '
+                'WHERE name = ?', (name,)).fetchone()
+
+    def save_token(self, name: str, access_token: str, refresh_token: str,
+                   expires_at: float) -> None:
+        with self._lock:
+            self._write('INSERT OR REPLACE INTO tokens VALUES (?, ?, ?, ?)',
+                        (name, access_token, refresh_token, expires_at))
+
+    def acquire(self, name: str, duration=LEASE_DURATION) -> bool:
+        """
+        Takes the lease `name` for duration seconds if no other process
+        holds it, or renews it if this process does.
+
+        :return: Whether this process holds the lease now
+        """
+        now = time.time()
+        with self._lock:
+            cursor = self._write(
+                'INSERT INTO leases VALUES (?, ?, ?) ON CONFLICT (name) DO UPDATE '
+                'SET owner = excluded.owner, until = excluded.until '
+                'WHERE leases.until < ? OR leases.owner = excluded.owner',
+                (name, self.owner, now + duration, now))
+            return cursor.rowcount > 0
+
+    def release(self, name: str) -> None:
+        """Gives up the lease `name` if this process holds it"""
+        with self._lock:
+            self._write('DELETE FROM leases WHERE name = ? AND owner = ?',
+                        (name, self.owner))
+
+    # API responses
+
+    def get_response(self, endpoint: str, key: str) -> Tuple[bool, Any, float]:
+        """
+        :return: Whether a fresh response of endpoint for key is stored,
+            the response and its seconds left to live
+        """
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                'SELECT expires, value FROM metadata '
+                'WHERE endpoint = ? AND key = ? AND expires > ?',
+                (endpoint, key, now)).fetchone()
+        if row is None:
+            return False, None, 0.0
+        return True, pickle.loads(row[1]), row[0] - now
+
+    def put_response(self, endpoint: str, key: str, value: Any, ttl: float) -> None:
+        """Stores a response for ttl seconds and drops the expired ones"""
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        now = time.time()
+        with self._lock, self._transaction() as db:
+            db.execute('DELETE FROM metadata WHERE expires <= ?', (now,))
+            db.execute('INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?)',
+                       (endpoint, key, now + ttl, data))
+
+    # image cache index
+
+    def image_size(self, filename: str) -> Optional[int]:
+        """
+        Returns the size of an indexed image, or None. Marks the image used
+        if its last use is older than USE_RESOLUTION, so most lookups only
+        read and do not queue for the write lock.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._db.execute('SELECT size, used FROM images WHERE filename = ?',
+                                   (filename,)).fetchone()
+            if row is None:
+                return None
+            size, used = row
+            if used < now - USE_RESOLUTION:
+                self._write('UPDATE images SET used = ? WHERE filename = ? AND used < ?',
+                            (now, filename, now))
+            return size
+
+    def add_image(self, filename: str, size: int, max_bytes: int) -> List[str]:
+        """
+        Indexes an image, then unindexes least recently used images until
+        the indexed images fit in max_bytes.
+
+        :return: The filenames unindexed, for the caller to delete
+        """
+        evicted = []
+        with self._lock, self._transaction() as db:
+            db.execute('INSERT OR REPLACE INTO images VALUES (?, ?, ?)',
+                       (filename, size, time.time()))
+            total, = db.execute('SELECT COALESCE(SUM(size), 0) FROM images').fetchone()
+            if total <= max_bytes:
+                return evicted
+
+            for name, size in db.execute('SELECT filename, size FROM images ORDER BY used'):
+                if total <= max_bytes:
+                    break
+                evicted.append(name)
+                total -= size
+            db.executemany('DELETE FROM images WHERE filename = ?',
+                           [(name,) for name in evicted])
+        return evicted
+
+    def index_images(self, images: List[Tuple[str, int, float]]) -> None:
+        """Indexes (filename, size, last used) of images not indexed yet"""
+        with self._lock, self._transaction() as db:
+            db.executemany('INSERT OR IGNORE INTO images VALUES (?, ?, ?)', images)
+
+    def remove_image(self, filename: str) -> None:
+        with self._lock:
+            self._write('DELETE FROM images WHERE filename = ?', (filename,))
+
+    def image_stats(self) -> Tuple[int, int]:
+        """Returns the number and total size of the indexed images"""
+        with self._lock:
+            return self._db.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM images').fetchone()
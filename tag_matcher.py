@@ -0,0 +1,129 @@
+from Levenshtein import ratio
+
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import functools
+import unicodedata
+
+# minimum similarity for a suggestion to replace the query
+THRESHOLD = 0.5
+# resolved queries kept in memory
+MAX_ENTRIES = 4096
+
+# katakana that have a hiragana counterpart 0x60 code points lower
+KATAKANA_START = 0x30A1
+KATAKANA_END = 0x30F6
+KANA_OFFSET = 0x60
+
+
+@functools.lru_cache(maxsize=MAX_ENTRIES)
+def normalize(text: str) -> str:
+    """
+    Folds text for comparison
+        - NFKC, which maps full/half width forms to their usual width
+        - case folding
+        - katakana to hiragana
+        - runs of whitespace to a single space
+    """
+    text = unicodedata.normalize('NFKC', text).casefold()
+    text = ''.join(chr(ord(char) - KANA_OFFSET)
+                   if KATAKANA_START <= ord(char) <= KATAKANA_END else char
+                   for char in text)
+    return ' '.join(text.split())
+
+
+def candidates(suggestions: Iterable[Dict[str, str]]) -> List[Tuple[str, str]]:
+    """
+    Returns (normalized string, tag name) for both the name and the
+    translated name of every autocomplete suggestion.
+    """
+    result = []
+    for suggestion in suggestions:
+        name = suggestion['name']
+        result.append((normalize(name), name))
+        translated = suggestion.get('translated_name')
+        if translated:
+            result.append((normalize(translated), name))
+    return result
+
+
+def best_match(query: str,
+               suggestions: Iterable[Dict[str, str]]) -> Tuple[Optional[str], float]:
+    """
+    Returns the name of the suggestion most similar to query and its
+    similarity in [0, 1], scoring every candidate string once. The name is
+    ``None`` if there are no suggestions.
+    """
+    folded = normalize(query)
+    best, confidence = None, 0.0
+    for candidate, name in candidates(suggestions):
+        if candidate == folded:
+            return name, 1.0
+        score = ratio(folded, candidate)
+        if score > confidence:
+            best, confidence = name, score
+    return best, confidence
+
+
+class TagMatcher:
+    """
+    Resolves user supplied tags to pixiv tags.
+        - queries and suggestions are compared after normalize(), so width,
+          case and kana variants of a tag match
+        - a suggestion is only used if its similarity is at least
+          `threshold`, otherwise the query is kept as is
+        - the last max_entries resolved queries are remembered
+    """
+
+    def __init__(self, threshold=THRESHOLD, max_entries=MAX_ENTRIES) -> None:
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self._resolved = OrderedDict() # normalized query -> tag
+
+    def get(self, query: str) -> Optional[str]:
+        """Returns the remembered resolution of query, or None"""
+        key = normalize(query)
+        tag = self._resolved.get(key)
+        if tag is None:
+            self.misses += 1
+            return None
+
+        self._resolved.move_to_end(key)
+        self.hits += 1
+        return tag
+
+    def match(self, query: str,
+              suggestions: Iterable[Dict[str, str]]) -> Optional[str]:
+        """Returns the best matching suggestion for query, None if not confident"""
+        best, confidence = best_match(query, suggestions)
+        return best if confidence >= self.threshold else None
+
+    def resolve(self, query: str, suggestions: Iterable[Dict[str, str]]) -> str:
+        """
+        Returns the best matching suggestion for query, or query itself if
+        there is no confident match, and remembers the result.
+        """
+        return self.remember(query, self.match(query, suggestions) or query)
+
+    def remember(self, query: str, tag: str) -> str:
+        """Remembers tag as the resolution of query and returns it"""
+        key = normalize(query)
+        self._resolved[key] = tag
+        self._resolved.move_to_end(key)
+        while len(self._resolved) > self.max_entries:
+            self._resolved.popitem(last=False)
+        return tag
+
+    def stats(self) -> dict:
+        """Returns the hit/miss counters and number of remembered queries"""
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+            'entries': len(self._resolved),
+        }
@@ -0,0 +1,118 @@
+from tag_matcher import normalize
+
+from typing import Dict, List, Optional, Tuple
+
+import json
+import sqlite3
+import threading
+import time
+
+# autocomplete suggestions are trusted this long, in seconds
+MAX_AGE = 30 * 24 * 60 * 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tags (
+    name            TEXT PRIMARY KEY,
+    translated_name TEXT,
+    updated         REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tag_keys (
+    key  TEXT NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (key, name)
+) WITHOUT ROWID;
+DROP TABLE IF EXISTS tag_trigrams;
+CREATE TABLE IF NOT EXISTS queries (
+    query   TEXT PRIMARY KEY,
+    names   TEXT NOT NULL,
+    updated REAL NOT NULL
+);
+"""
+
+# (answered, candidates), see TagStore.lookup
+TagLookup = Tuple[Optional[List[Dict[str, str]]], List[Dict[str, str]]]
+
+
+class TagStore:
+    """
+    SQLite dictionary of pixiv tags, filled from autocomplete responses.
+        - tags are indexed by the normalized form of their name and
+          translated name, so a query naming a known tag resolves without
+          the API even if it was never asked before
+        - the suggestions returned for every query are kept, so a query
+          seen before is answered exactly like the API did
+        - entries older than max_age are ignored until the API is asked
+          again and refreshes them
+    Methods do blocking file I/O; async callers should run them in an
+    executor.
+    """
+
+    def __init__(self, path: str, max_age=MAX_AGE) -> None:
+        self.path = path
+        self.max_age = max_age
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(SCHEMA)
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+    def _suggestions(self, names: List[str], since: float) -> List[Dict[str, str]]:
+        """Returns the fresh tags among names as autocomplete suggestions"""
+        if not names:
+            return []
+        translations = dict(self._db.execute(
+            'SELECT name, translated_name FROM tags '
+            f'WHERE updated >= ? AND name IN ({",".join("?" * len(names))})',
+            (since, *names)))
+        return [{'name': name, 'translated_name': translations[name]}
+                for name in names if name in translations]
+
+    def lookup(self, query: str) -> TagLookup:
+        """
+        Looks query up without asking the API.
+
+        :return: The suggestions the API returned for query if they are
+            still fresh, else ``None``; and the fresh tags whose name or
+            translated name equals query after normalize().
+        """
+        folded = normalize(query)
+        since = time.time() - self.max_age
+
+        with self._lock:
+            row = self._db.execute(
+                'SELECT names FROM queries WHERE query = ? AND updated >= ?',
+                (folded, since)).fetchone()
+            if row is not None:
+                return self._suggestions(json.loads(row[0]), since), []
+
+            names = [name for name, in self._db.execute(
+                'SELECT name FROM tag_keys WHERE key = ?', (folded,))]
+            return None, self._suggestions(names, since)
+
+    def add(self, query: str, suggestions: List[Dict[str, str]]) -> None:
+        """Stores the autocomplete suggestions returned for query"""
+        now = time.time()
+        with self._lock, self._db:
+            for suggestion in suggestions:
+                name = suggestion['name']
+                translated = suggestion.get('translated_name')
+                self._db.execute(
+                    'INSERT OR REPLACE INTO tags VALUES (?, ?, ?)',
+                    (name, translated, now))
+
+                keys = {normalize(name)}
+                if translated:
+                    keys.add(normalize(translated))
+                self._db.executemany(
+                    'INSERT OR IGNORE INTO tag_keys VALUES (?, ?)',
+                    [(key, name) for key in keys])
+
+            self._db.execute(
+                'INSERT OR REPLACE INTO queries VALUES (?, ?, ?)',
+                (normalize(query),
+                 json.dumps([suggestion['name'] for suggestion in suggestions]),
+                 now))